@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of django-thumbnail-works.
+#
+#  django-thumbnail-works adds thumbnail support to the default ImageField.
+#
+#  Development Web Site:
+#    - http://www.codetrax.org/projects/django-thumbnail-works
+#  Public Source Code Repository:
+#    - https://source.codetrax.org/hgroot/django-thumbnail-works
+#
+#  Copyright 2010 George Notaras <gnot [at] g-loaded.eu>
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""Image processing backends.
+
+A backend generates several images out of the same source image data. The
+backend of an ``EnhancedImageField`` is set by its ``processing_backend``
+argument, or by the ``THUMBNAILS_PROCESSING_BACKEND`` setting.
+
+"""
+
+import atexit
+import mmap
+import os
+import tempfile
+import threading
+from multiprocessing import Pool, cpu_count
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+from thumbnail_works import settings
+from thumbnail_works.images import ImageContent, ImageProcessor, pass_through_images, process_images
+from thumbnail_works.utils import import_object
+
+
+class InProcessBackend(object):
+    """Processes the images in the current process.
+    
+    See ``thumbnail_works.images.process_images()``.
+    
+    """
+    
+    def process_images(self, processors, content, close=False):
+        """Returns a list of ImageContent objects, one for each of the
+        ``processors``, out of the source image data ``content``. If
+        ``close`` is True, ``content`` is closed once it has been decoded."""
+        return process_images(processors, content, close)
+
+
+class ProcessPoolBackend(object):
+    """Processes the images in a pool of worker processes.
+    
+    The source image is decoded once in the current process. The decoded
+    pixels are written to a memory mapped file, which the workers map
+    instead of receiving a pickled copy of the image. Each worker resizes,
+    filters and encodes one image and returns the encoded data only.
+    
+    The pool has ``THUMBNAILS_WORKERS`` processes, or one process per CPU if
+    that setting is less than 2. Since the workers use plain
+    ``ImageProcessor`` objects, processors that override the image
+    processing methods should use the ``InProcessBackend``.
+    
+    """
+    
+    def __init__(self):
+        self._pool = None
+        self._pool_lock = threading.Lock()
+    
+    def get_pool(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    workers = settings.THUMBNAILS_WORKERS
+                    if workers < 2:
+                        workers = cpu_count()
+                    self._pool = Pool(workers)
+                    atexit.register(self._pool.terminate)
+        return self._pool
+    
+    def process_images(self, processors, content, close=False):
+        """Returns a list of ImageContent objects, one for each of the
+        ``processors``, out of the source image data ``content``. If
+        ``close`` is True, ``content`` is closed once it has been decoded."""
+        if not processors:
+            return []
+        return pass_through_images(processors, content, self._process_images, close)
+    
+    def _process_images(self, processors, content, close=False):
+        im = processors[0].open_image(content, processors, close)
+        data = im.tobytes()
+        
+        # /dev/shm keeps the mapped file in memory where available
+        shm_dir = os.path.isdir('/dev/shm') and '/dev/shm' or None
+        fd, path = tempfile.mkstemp(prefix='thumbnail_works-', dir=shm_dir)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            del data
+            tasks = []
+            for processor in processors:
+                tasks.append((path, im.mode, im.size, processor.identifier,
+                    processor.proc_opts, processor.source_metadata))
+            results = self.get_pool().map(_process_shared_image, tasks)
+        finally:
+            os.remove(path)
+        contents = []
+        for data, image_size, image_format in results:
+            contents.append(ImageContent(StringIO(data), image_size, image_format))
+        return contents
+
+
+def _process_shared_image(task):
+    """Processes one image out of the pixels in a memory mapped file.
+    
+    Runs in the worker processes of the ``ProcessPoolBackend``. Returns the
+    arguments of the ``ImageContent`` of the processed image.
+    
+    """
+    path, mode, size, identifier, proc_opts, source_metadata = task
+    f = open(path, 'rb')
+    try:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    im = Image.frombuffer(mode, size, buffer, 'raw', mode, 0, 1)
+    processor = ImageProcessor()
+    processor.identifier = identifier
+    processor.setup_image_processing_options(proc_opts)
+    processor.source_metadata = source_metadata
+    im = processor.filter_image(processor.resize_image(im))
+    content = processor.encode_image(im)
+    try:
+        return content.read(), content.image_size, content.image_format
+    finally:
+        content.close()
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(path=None):
+    """Returns the shared instance of the backend class at the dotted
+    ``path``. Defaults to the ``THUMBNAILS_PROCESSING_BACKEND`` setting."""
+    if path is None:
+        path = settings.THUMBNAILS_PROCESSING_BACKEND
+    if path not in _backends:
+        with _backends_lock:
+            if path not in _backends:
+                _backends[path] = import_object(path)()
+    return _backends[path]
@@ -0,0 +1,545 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of django-thumbnail-works.
+#
+#  django-thumbnail-works adds thumbnail support to the default ImageField.
+#
+#  Development Web Site:
+#    - http://www.codetrax.org/projects/django-thumbnail-works
+#  Public Source Code Repository:
+#    - https://source.codetrax.org/hgroot/django-thumbnail-works
+#
+#  Copyright 2010 George Notaras <gnot [at] g-loaded.eu>
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""Benchmarks of the image processing pipeline and the field lifecycle.
+
+The benchmarks use synthetic source images (JPEG, PNG, RGBA, palette and
+CMYK images at several sizes, with and without EXIF orientation), so they can
+be run without any external data::
+
+    python -m thumbnail_works.benchmark --output results.json
+
+The results are written as JSON, so that they can be compared between
+releases. Django settings are configured with the defaults if
+``DJANGO_SETTINGS_MODULE`` has not been set.
+
+"""
+
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+try:
+    from PIL import Image, ImageDraw
+except ImportError:
+    import Image
+    import ImageDraw
+
+
+DEFAULT_THUMBNAILS = {
+    'large': dict(size='1024x768'),
+    'medium': dict(size='512x384', sharpen=True),
+    'small': dict(size='256x192'),
+    'avatar': dict(size='80x60'),
+    }
+
+BACKENDS = (
+    'thumbnail_works.backends.InProcessBackend',
+    'thumbnail_works.backends.ProcessPoolBackend',
+    )
+
+# (name, format, mode, EXIF orientation)
+SOURCES = (
+    ('jpeg', 'JPEG', 'RGB', None),
+    ('jpeg-rotated', 'JPEG', 'RGB', 6),
+    ('jpeg-cmyk', 'JPEG', 'CMYK', None),
+    ('png', 'PNG', 'RGB', None),
+    ('png-rgba', 'PNG', 'RGBA', None),
+    ('png-palette', 'PNG', 'P', None),
+    )
+
+DEFAULT_SIZES = '640x480,2048x1536,4000x3000'
+
+# name -> (format, encoder_options)
+ENCODER_PROFILES = (
+    ('jpeg', 'JPEG', {}),
+    ('jpeg-optimized', 'JPEG', {'optimize': True}),
+    ('jpeg-progressive', 'JPEG', {'optimize': True, 'progressive': True}),
+    ('jpeg-q70-420', 'JPEG', {'quality': 70, 'subsampling': 2}),
+    ('png', 'PNG', {}),
+    ('png-fast', 'PNG', {'compress_level': 1}),
+    ('png-small', 'PNG', {'compress_level': 9, 'optimize': True}),
+    ('webp', 'WEBP', {}),
+    ('webp-q80-m6', 'WEBP', {'quality': 80, 'method': 6}),
+    ('avif', 'AVIF', {}),
+    )
+
+
+def make_source_image(size, format='JPEG', mode='RGB', orientation=None):
+    """Returns the data of a synthetic image with some detail in it.
+    
+    Raises ValueError if ``orientation`` is set, but the installed PIL
+    cannot write EXIF data.
+    
+    """
+    im = Image.new('RGB', size)
+    draw = ImageDraw.Draw(im)
+    width, height = size
+    for x in range(0, width, 16):
+        draw.line((x, 0, width - x, height), fill=(x % 256, 96, 255 - x % 256), width=3)
+    for y in range(0, height, 24):
+        draw.line((0, y, width, height - y), fill=(64, y % 256, 128), width=2)
+    if mode == 'RGBA':
+        im.putalpha(im.convert('L'))
+    elif mode == 'P':
+        im = im.convert('P', palette=Image.ADAPTIVE)
+    elif mode != 'RGB':
+        im = im.convert(mode)
+    options = {}
+    if orientation is not None:
+        if not hasattr(Image, 'Exif'):
+            raise ValueError('Writing EXIF data is not supported')
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        options['exif'] = exif.tobytes()
+    buffer = StringIO()
+    im.save(buffer, format, **options)
+    return buffer.getvalue()
+
+
+def get_processors(thumbnails):
+    """Returns an ``ImageProcessor`` for each of the thumbnail definitions."""
+    from thumbnail_works.images import ImageProcessor
+    processors = []
+    for identifier, proc_opts in sorted(thumbnails.items()):
+        processor = ImageProcessor()
+        processor.identifier = identifier
+        processor.setup_image_processing_options(proc_opts)
+        processors.append(processor)
+    return processors
+
+
+def measure(func, repeat):
+    """Returns the best wall clock time of ``repeat`` calls of ``func``."""
+    timings = []
+    for i in range(repeat):
+        start = time.time()
+        func()
+        timings.append(time.time() - start)
+    return min(timings)
+
+
+def get_sources(sizes):
+    """Yields (name, size, data) for each of the synthetic source images."""
+    for size in sizes:
+        for name, format, mode, orientation in SOURCES:
+            try:
+                data = make_source_image(size, format, mode, orientation)
+            except ValueError:
+                continue
+            yield name, size, data
+
+
+def get_output_format(name):
+    # Keep the alpha channel
+    if name == 'png-rgba':
+        return 'PNG'
+    return 'JPEG'
+
+
+def benchmark_pipeline(sizes, thumbnails=DEFAULT_THUMBNAILS, repeat=3):
+    """Measures each stage of ``ImageProcessor.process_image()`` for every
+    synthetic source image and thumbnail definition."""
+    from django.core.files.base import ContentFile
+    results = []
+    for name, size, data in get_sources(sizes):
+        for identifier, proc_opts in sorted(thumbnails.items()):
+            proc_opts = dict(proc_opts, format=get_output_format(name))
+            processor = get_processors({identifier: proc_opts})[0]
+            stages = {}
+            for i in range(repeat):
+                timings = {}
+                start = time.time()
+                im = processor.open_image(ContentFile(data))
+                timings['decode'] = time.time() - start
+                start = time.time()
+                im = processor.resize_image(im)
+                timings['resize'] = time.time() - start
+                start = time.time()
+                im = processor.filter_image(im)
+                timings['filter'] = time.time() - start
+                start = time.time()
+                content = processor.encode_image(im)
+                timings['encode'] = time.time() - start
+                timings['total'] = sum(timings.values())
+                for stage, seconds in timings.items():
+                    stages[stage] = min(stages.get(stage, seconds), seconds)
+            results.append({
+                'source': name,
+                'source_size': list(size),
+                'thumbnail': identifier,
+                'output_size': list(content.image_size),
+                'output_bytes': content.size,
+                'seconds': stages,
+                })
+            content.close()
+    return results
+
+
+def get_storage_class():
+    from django.core.files.storage import FileSystemStorage
+    
+    class LatencyStorage(FileSystemStorage):
+        """A FileSystemStorage that behaves like a remote storage.
+        
+        Each call sleeps for ``latency`` seconds and opened files are read
+        into memory, since remote files are not backed by local files.
+        
+        """
+        
+        def __init__(self, latency, *args, **kwargs):
+            self.latency = latency
+            super(LatencyStorage, self).__init__(*args, **kwargs)
+        
+        def _open(self, name, mode='rb'):
+            from django.core.files.base import File
+            time.sleep(self.latency)
+            f = super(LatencyStorage, self)._open(name, mode)
+            try:
+                return File(StringIO(f.read()), name=name)
+            finally:
+                f.close()
+        
+        def _save(self, name, content):
+            time.sleep(self.latency)
+            return super(LatencyStorage, self)._save(name, content)
+        
+        def delete(self, name):
+            time.sleep(self.latency)
+            return super(LatencyStorage, self).delete(name)
+        
+        def exists(self, name):
+            time.sleep(self.latency)
+            return super(LatencyStorage, self).exists(name)
+        
+        def listdir(self, path):
+            time.sleep(self.latency)
+            return super(LatencyStorage, self).listdir(path)
+        
+        def size(self, name):
+            time.sleep(self.latency)
+            return super(LatencyStorage, self).size(name)
+    
+    return LatencyStorage
+
+
+class _Instance(object):
+    """Stands in for a model instance."""
+
+
+def benchmark_lifecycle(storage, data, thumbnails=DEFAULT_THUMBNAILS, repeat=3):
+    """Measures the ``EnhancedImageFieldFile`` lifecycle on ``storage``.
+    
+    The measured steps are saving the source image, saving it together with
+    all the thumbnails, accessing the thumbnails for the first time (which
+    generates them), accessing them on a new object while they are in the
+    manifest and while only the storage knows about them, and deleting the
+    source image and the thumbnails.
+    
+    """
+    from django.core.files.base import ContentFile
+    from thumbnail_works import settings
+    from thumbnail_works.fields import EnhancedImageField
+    from thumbnail_works.manifest import manifest
+    
+    field = EnhancedImageField(upload_to='benchmark', storage=storage, thumbnails=thumbnails)
+    field.set_attributes_from_name('image')
+    identifiers = sorted(thumbnails.keys())
+    
+    def access(name):
+        source = field.attr_class(_Instance(), field, name)
+        for identifier in identifiers:
+            getattr(source, identifier)
+    
+    steps = {}
+    delayed_generation = settings.THUMBNAILS_DELAYED_GENERATION
+    try:
+        for i in range(repeat):
+            timings = {}
+            manifest.clear()
+            
+            settings.THUMBNAILS_DELAYED_GENERATION = False
+            source = field.attr_class(_Instance(), field, None)
+            start = time.time()
+            source.save('image.jpg', ContentFile(data), save=False)
+            timings['save_with_thumbnails'] = time.time() - start
+            source.delete(save=False)
+            
+            settings.THUMBNAILS_DELAYED_GENERATION = True
+            source = field.attr_class(_Instance(), field, None)
+            start = time.time()
+            source.save('image.jpg', ContentFile(data), save=False)
+            timings['save'] = time.time() - start
+            
+            start = time.time()
+            for identifier in identifiers:
+                getattr(source, identifier)
+            timings['first_access'] = time.time() - start
+            
+            start = time.time()
+            access(source.name)
+            timings['manifest_access'] = time.time() - start
+            
+            manifest.clear()
+            start = time.time()
+            access(source.name)
+            timings['storage_access'] = time.time() - start
+            
+            start = time.time()
+            source.delete(save=False)
+            timings['delete'] = time.time() - start
+            
+            for step, seconds in timings.items():
+                steps[step] = min(steps.get(step, seconds), seconds)
+    finally:
+        settings.THUMBNAILS_DELAYED_GENERATION = delayed_generation
+        manifest.clear()
+    return steps
+
+
+def benchmark_storages(size=(2048, 1536), latency=0.02, repeat=3):
+    """Runs ``benchmark_lifecycle()`` on a local FileSystemStorage and on a
+    storage that adds ``latency`` seconds to every call."""
+    from django.core.files.storage import FileSystemStorage
+    data = make_source_image(size)
+    location = tempfile.mkdtemp(prefix='thumbnail_works-benchmark-')
+    try:
+        storages = {
+            'filesystem': FileSystemStorage(location=location, base_url='/media/'),
+            'remote': get_storage_class()(latency, location=location, base_url='/media/'),
+            }
+        results = {}
+        for name, storage in storages.items():
+            results[name] = benchmark_lifecycle(storage, data, repeat=repeat)
+        return results
+    finally:
+        shutil.rmtree(location, ignore_errors=True)
+
+
+def benchmark_backends(source_size=(4000, 3000), thumbnails=DEFAULT_THUMBNAILS, repeat=3):
+    """Compares the time the processing backends need to generate all the
+    ``thumbnails`` of a JPEG source image of ``source_size``."""
+    from django.core.files.base import ContentFile
+    from thumbnail_works.backends import get_backend
+    data = make_source_image(source_size)
+    processors = get_processors(thumbnails)
+    results = {}
+    for path in BACKENDS:
+        backend = get_backend(path)
+        # Warm up, which also starts the worker processes
+        backend.process_images(processors, ContentFile(data))
+        results[path] = measure(
+            lambda: backend.process_images(processors, ContentFile(data)), repeat)
+    return results
+
+
+def measure_peak_memory(func):
+    """Calls ``func`` in a forked child process and returns the peak
+    resident memory of that process in bytes, or None if the platform does
+    not support ``fork()`` and ``getrusage()``."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    if not hasattr(os, 'fork'):
+        return None
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            func()
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # Mac OS X reports bytes, other systems kilobytes
+            if sys.platform != 'darwin':
+                peak *= 1024
+            os.write(write_fd, ('%d' % peak).encode('ascii'))
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    try:
+        data = os.read(read_fd, 64)
+    finally:
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+    if not data:
+        return None
+    return int(data)
+
+
+def benchmark_encoders(image_size=(512, 384), repeat=3):
+    """Measures the encoding time and the size of the data of an image of
+    ``image_size`` with each of the ``ENCODER_PROFILES``. Formats that the
+    installed PIL cannot write are skipped."""
+    from django.core.files.base import ContentFile
+    im = get_processors({'source': {}})[0].open_image(ContentFile(make_source_image(image_size)))
+    results = {}
+    for name, format, encoder_options in ENCODER_PROFILES:
+        if format not in Image.SAVE:
+            try:
+                Image.init()
+            except AttributeError:
+                pass
+            if format not in Image.SAVE:
+                continue
+        processor = get_processors({name: dict(format=format, encoder_options=encoder_options)})[0]
+        sizes = []
+        def encode():
+            content = processor.encode_image(im)
+            sizes.append(content.size)
+            content.close()
+        results[name] = {'seconds': measure(encode, repeat), 'bytes': sizes[-1]}
+    return results
+
+
+def benchmark_resample(image_size=(4000, 3000), sizes=((64, 64), (320, 240)), repeat=3):
+    """Measures the time it takes to resize an image of ``image_size`` to
+    each of ``sizes`` with each combination of the ``resample`` and ``speed``
+    options."""
+    from django.core.files.base import ContentFile
+    from thumbnail_works.images import SPEED_PROFILES
+    im = get_processors({'source': {}})[0].open_image(ContentFile(make_source_image(image_size)))
+    results = {}
+    for size in sizes:
+        for resample in ('lanczos', 'bicubic'):
+            for speed in sorted(SPEED_PROFILES):
+                processor = get_processors({'test': dict(
+                    size='%dx%d' % size, crop=True, resample=resample, speed=speed)})[0]
+                key = '%dx%d %s %s' % (size[0], size[1], resample, speed)
+                results[key] = measure(lambda: processor.resize_image(im), repeat)
+    return results
+
+
+def benchmark_encode_memory(image_size=(2048, 1536), format='JPEG'):
+    """Compares the peak memory of encoding an image and passing it to
+    the storage with ``ImageProcessor.encode_image()`` against encoding it to
+    a string buffer and copying it to a ContentFile.
+    
+    Each way is measured in its own child process (see
+    ``measure_peak_memory()``). Both processes start with the decoded image,
+    so the difference of the peaks is the memory that the copies of the
+    data need.
+    
+    """
+    from django.core.files.base import ContentFile
+    from thumbnail_works import settings
+    im = Image.open(StringIO(make_source_image(image_size, format)))
+    im.load()
+    processor = get_processors({'test': dict(format=format)})[0]
+    
+    def consume(content):
+        # What storages do with the content
+        for chunk in content.chunks():
+            pass
+    
+    def encode_to_string():
+        buffer = StringIO()
+        if format == 'JPEG':
+            im.save(buffer, format, quality=settings.THUMBNAILS_QUALITY)
+        else:
+            im.save(buffer, format)
+        consume(ContentFile(buffer.getvalue()))
+    
+    def encode_image():
+        content = processor.encode_image(im)
+        consume(content)
+        content.close()
+    
+    return {
+        'string_buffer': measure_peak_memory(encode_to_string),
+        'encode_image': measure_peak_memory(encode_image),
+        }
+
+
+def get_environment():
+    """Returns the versions and settings the results depend on."""
+    from thumbnail_works import get_version, settings
+    pil_version = getattr(Image, '__version__', None) or getattr(Image, 'VERSION', None)
+    return {
+        'thumbnail_works': get_version(),
+        'python': platform.python_version(),
+        'pil': pil_version,
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'settings': dict((name, getattr(settings, name)) for name in dir(settings)
+            if name.startswith('THUMBNAILS_')),
+        }
+
+
+def main(argv=None):
+    parser = OptionParser('%prog [options]')
+    parser.add_option('-s', '--sizes', default=DEFAULT_SIZES,
+        help='comma separated sizes of the source images [%default]')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+        help='number of runs of each benchmark [%default]')
+    parser.add_option('-l', '--latency', type='float', default=0.02,
+        help='latency of the remote storage in seconds [%default]')
+    parser.add_option('-o', '--output', default=None,
+        help='file to write the JSON results to [stdout]')
+    options, args = parser.parse_args(argv)
+    
+    from django.conf import settings
+    if not settings.configured:
+        settings.configure()
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+    from thumbnail_works.utils import get_width_height_from_string
+    
+    sizes = [get_width_height_from_string(size) for size in options.sizes.split(',')]
+    results = {
+        'environment': get_environment(),
+        'pipeline': benchmark_pipeline(sizes, repeat=options.repeat),
+        'lifecycle': benchmark_storages(sizes[-1], options.latency, options.repeat),
+        'backends': benchmark_backends(sizes[-1], repeat=options.repeat),
+        'encoders': benchmark_encoders(repeat=options.repeat),
+        'resample': benchmark_resample(repeat=options.repeat),
+        'encode_memory': benchmark_encode_memory(),
+        }
+    
+    if options.output:
+        f = open(options.output, 'w')
+    else:
+        f = sys.stdout
+    try:
+        json.dump(results, f, indent=2, sort_keys=True, default=str)
+        f.write('\n')
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+
+if __name__ == '__main__':
+    main()
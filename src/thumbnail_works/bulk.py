@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of django-thumbnail-works.
+#
+#  django-thumbnail-works adds thumbnail support to the default ImageField.
+#
+#  Development Web Site:
+#    - http://www.codetrax.org/projects/django-thumbnail-works
+#  Public Source Code Repository:
+#    - https://source.codetrax.org/hgroot/django-thumbnail-works
+#
+#  Copyright 2010 George Notaras <gnot [at] g-loaded.eu>
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""Operations on the thumbnails of many images at once."""
+
+import os
+
+from django.db import transaction
+from django.utils.encoding import smart_unicode
+
+from thumbnail_works.fields import ThumbnailFieldFile
+from thumbnail_works.manifest import manifest
+from thumbnail_works.metrics import collector
+from thumbnail_works.workers import run_tasks
+
+
+def list_files(storage, dirname):
+    """Returns the set of the names of the files in ``dirname`` on
+    ``storage``, or None if the storage cannot list directories."""
+    collector.increment('thumbnail_works_storage_listdir_total')
+    try:
+        directories, files = storage.listdir(dirname)
+    except NotImplementedError:
+        return None
+    except (IOError, OSError):
+        # The directory does not exist yet
+        return set()
+    return set(files)
+
+
+def prefetch_thumbnails(objects, field_name, identifiers=None, generate=False):
+    """Finds the thumbnails of many objects at once and sets them as
+    attributes of their source images.
+    
+    ``objects``
+        A queryset or a list of model instances.
+    ``field_name``
+        The name of the ``EnhancedImageField`` of the model.
+    ``identifiers``
+        The identifiers of the thumbnails to find. Defaults to all the
+        thumbnails of the field.
+    ``generate``
+        If True, the missing thumbnails are generated, concurrently if
+        ``THUMBNAILS_WORKERS`` is set, or put on the generation queue (see
+        ``BaseEnhancedImageFieldFile._generate_found_missing()``). Objects
+        whose source image cannot be read are skipped.
+    
+    The thumbnails are looked up in the manifest first. The directories of
+    the remaining thumbnails are then listed once each, instead of checking
+    the existence of every thumbnail on the storage. Accessing a thumbnail
+    that has been found does not access the storage again.
+    
+    Returns the objects as a list.
+    
+    """
+    objects = list(objects)
+    sources = []
+    for obj in objects:
+        source = getattr(obj, field_name)
+        if source and source._verify_thumbnail_requirements():
+            sources.append(source)
+    
+    metric = 'thumbnail_works_thumbnail_lookups_total'
+    unresolved = {}
+    for source in sources:
+        if identifiers is None:
+            source_identifiers = source.field.thumbnail_specs.keys()
+        else:
+            source_identifiers = identifiers
+        for identifier in source_identifiers:
+            if identifier in source.__dict__:
+                continue
+            spec = source.field.thumbnail_specs[identifier]
+            t = ThumbnailFieldFile(source.instance, source.field, source, source.name, identifier, spec)
+            entry = manifest.get(source.name, t.identifier, spec)
+            if entry is not None and not entry.get('missing'):
+                t.set_metadata(entry)
+                setattr(source, identifier, t)
+                collector.increment(metric, identifier=t.identifier, result='manifest')
+                continue
+            key = (source.storage, os.path.dirname(t.name))
+            unresolved.setdefault(key, []).append((source, identifier, t))
+    
+    missing = {}
+    for (storage, dirname), thumbnails in unresolved.items():
+        files = list_files(storage, smart_unicode(dirname))
+        for source, identifier, t in thumbnails:
+            if files is None:
+                collector.increment('thumbnail_works_storage_exists_total')
+                exists = storage.exists(smart_unicode(t.name))
+            else:
+                exists = os.path.basename(t.name) in files
+            if exists:
+                manifest.set(source.name, t.identifier, t.spec, {'name': t.name})
+                setattr(source, identifier, t)
+                collector.increment(metric, identifier=t.identifier, result='storage')
+            else:
+                manifest.set(source.name, t.identifier, t.spec, {'name': t.name, 'missing': True})
+                collector.increment(metric, identifier=t.identifier, result='missing')
+                # Source images are compared by name, so they are keyed by id
+                missing.setdefault(id(source), (source, []))[1].append(t)
+    
+    if generate and missing:
+        # The thumbnails are known to be missing, so they are not looked up again
+        run_tasks(lambda args: args[0]._generate_found_missing(args[1]),
+            missing.values())
+    return objects
+
+
+def delete_files(storage, names):
+    """Deletes the files ``names`` from ``storage``.
+    
+    Storages that provide a ``delete_many(names)`` method, which deletes
+    several files with one request, are given all the names at once.
+    Otherwise the files are deleted concurrently if ``THUMBNAILS_WORKERS``
+    is set.
+    
+    """
+    names = [smart_unicode(name) for name in names]
+    if not names:
+        return
+    delete_many = getattr(storage, 'delete_many', None)
+    if delete_many is not None:
+        delete_many(names)
+    else:
+        run_tasks(storage.delete, names)
+
+
+def delete_images(objects, field_name, on_commit=False, using=None):
+    """Deletes the source images and the thumbnails of many objects.
+    
+    ``objects``
+        A queryset or a list of model instances.
+    ``field_name``
+        The name of the ``EnhancedImageField`` of the model.
+    ``on_commit``
+        If True, the files are deleted once the current database transaction
+        of ``using`` has been committed, so that the transaction is not kept
+        open while the storage is accessed and the files are kept if it is
+        rolled back. This requires Django 1.9 or later; with older versions
+        the files are deleted immediately.
+    
+    The names of the files are collected when this function is called, so
+    the objects themselves can be deleted right afterwards::
+    
+        photos = Photo.objects.filter(album=album)
+        delete_images(photos, 'image', on_commit=True)
+        photos.delete()
+    
+    The files of each storage are deleted with ``delete_files()``. The
+    thumbnails are also removed from the manifest. The field values of the
+    objects are not changed. The images of ``content_addressed`` fields that
+    are shared with other objects are not deleted.
+    
+    Returns the number of files that are deleted.
+    
+    """
+    sources = []
+    for obj in objects:
+        source = getattr(obj, field_name)
+        if source and source.name:
+            sources.append(source)
+    
+    shared = set()
+    if sources and sources[0].field.content_addressed:
+        field = sources[0].field
+        names = [source.name for source in sources]
+        pks = [source.instance.pk for source in sources]
+        others = field.model._default_manager.filter(**{'%s__in' % field.name: names})
+        shared = set(others.exclude(pk__in=pks).values_list(field.name, flat=True))
+    
+    files = {}
+    for source in sources:
+        if source.name in shared:
+            continue
+        names = files.setdefault(source.storage, set())
+        for identifier, spec in source.field.thumbnail_specs.items():
+            entry = manifest.get(source.name, spec.identifier, spec)
+            if entry is not None and not entry.get('missing'):
+                names.add(entry['name'])
+            else:
+                names.add(spec.get_image_name(source.name))
+            manifest.delete(source.name, spec.identifier, spec)
+        names.add(source.name)
+    
+    def delete():
+        for storage, names in files.items():
+            delete_files(storage, sorted(names))
+    
+    if on_commit and hasattr(transaction, 'on_commit'):
+        transaction.on_commit(delete, using=using)
+    else:
+        delete()
+    return sum([len(names) for names in files.values()])
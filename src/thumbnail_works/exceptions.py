@@ -45,3 +45,8 @@ class ThumbnailWorksError(Exception):
 
 class NoAccessToImage(Exception):
     pass
+
+class ImageTooLargeError(Exception):
+    """Raised instead of decoding an image that exceeds the
+    ``THUMBNAILS_MAX_PIXELS`` or ``THUMBNAILS_MEMORY_BUDGET`` limits."""
+    pass
@@ -24,14 +24,25 @@
 #  limitations under the License.
 #
 
+import os
+import time
+from hashlib import sha1
+
 from django.db.models.fields.files import ImageField, ImageFieldFile
 from django.utils.encoding import smart_unicode
 
-from thumbnail_works.exceptions import ThumbnailOptionError
 from thumbnail_works.exceptions import ThumbnailWorksError
 from thumbnail_works.exceptions import NoAccessToImage
 from thumbnail_works import settings
-from thumbnail_works.images import ImageProcessor
+from thumbnail_works.backends import get_backend
+from thumbnail_works.images import ImageContent, ImageProcessor, ImageSpec
+from thumbnail_works.images import clean_identifier
+from thumbnail_works.locks import get_lock
+from thumbnail_works.manifest import manifest
+from thumbnail_works.metrics import collector
+from thumbnail_works.queues import get_generation_queue
+from thumbnail_works.signals import start_stage, end_stage
+from thumbnail_works.workers import run_tasks
 
 
 
@@ -82,38 +93,87 @@ class BaseThumbnailFieldFile(ImageFieldFile):
         super(BaseThumbnailFieldFile, self).__init__(instance, field, name)
     
     def get_identifier(self, identifier):
-        if not isinstance(identifier, str):
-            raise ThumbnailOptionError('The identifier must be a string')
-        elif identifier == '':
-            raise ThumbnailOptionError('The identifier must be set to something on thumbnails')
-        return identifier.replace(' ', '_')
+        return clean_identifier(identifier)
     
-    def save(self, source_content=None):
+    def save(self, source_content=None, thumbnail_content=None, started=None):
         """Saves the thumbnail file.
         
         ``source_content``
             The image data of the source image
+        ``thumbnail_content``
+            The already processed image data of the thumbnail. If this is
+            set, ``source_content`` is ignored and no image processing takes
+            place.
+        ``started``
+            The time the processing of ``thumbnail_content`` started, which
+            the generation latency metric is measured from. Defaults to now.
         
         Also sets the current object (thumbnail) as an attribute of the
         source image's ImageFieldFile.
         
         """
+        if started is None:
+            started = time.time()
+        
         # Set the thumbnail as an attribute of the source image's ImageFieldFile
         setattr(self.source, self.identifier, self)
 
-        if source_content is None:
-            try:
-                source_content = self.source.get_image_content()
-            except NoAccessToImage:
-                return
+        if thumbnail_content is None:
+            if source_content is not None:
+                thumbnail_content = self.process_image(source_content)
+            else:
+                try:
+                    source_content = self.source.get_image_content()
+                except NoAccessToImage:
+                    return
+                try:
+                    # The source file is closed once it has been decoded
+                    thumbnail_content = self.process_image(source_content, close=True)
+                finally:
+                    source_content.close()
         
-        thumbnail_content = self.process_image(source_content)
-        self.name = self.storage.save(self.name, thumbnail_content)
+        start = start_stage()
+        try:
+            self.name = self.storage.save(self.name, thumbnail_content)
+        finally:
+            thumbnail_content.close()
+        end_stage(self, 'save', start,
+            getattr(thumbnail_content, 'image_size', None))
 
         # Update the filesize cache
-        self._size = len(thumbnail_content)
+        self._size = thumbnail_content.size
         
         self._committed = True
+        
+        # Record the thumbnail in the manifest. The dimensions are also
+        # cached, so that they are never read from the storage.
+        metadata = {'name': self.name, 'size': self._size}
+        if isinstance(thumbnail_content, ImageContent):
+            metadata['width'], metadata['height'] = thumbnail_content.image_size
+            metadata['format'] = thumbnail_content.image_format
+        self.set_metadata(metadata)
+        manifest.set(self.source.name, self.identifier, self.spec, metadata)
+        
+        collector.increment('thumbnail_works_thumbnails_generated_total',
+            identifier=self.identifier)
+        collector.observe('thumbnail_works_generation_seconds',
+            time.time() - started, identifier=self.identifier)
+    
+    def set_metadata(self, metadata):
+        """Sets the name of the thumbnail and seeds the file size and
+        dimensions caches from the thumbnail's manifest entry."""
+        self.name = metadata['name']
+        if 'size' in metadata:
+            self._size = metadata['size']
+        if 'width' in metadata:
+            self._dimensions_cache = (metadata['width'], metadata['height'])
+    
+    def _get_size(self):
+        # Use the filesize cache, if set, instead of asking the storage
+        if hasattr(self, '_size'):
+            return self._size
+        return ImageFieldFile.size.fget(self)
+    size = property(_get_size)
 
     def delete(self):
         """Deletes the thumbnail file.
@@ -129,11 +189,14 @@ class BaseThumbnailFieldFile(ImageFieldFile):
             del self.file
 
         self.storage.delete(self.name)
+        manifest.delete(self.source.name, self.identifier, self.spec)
 
         self.name = None
         
-        # Clear the thumbnail attribute on the source image file
-        if hasattr(self.source, self.identifier):
+        # Clear the thumbnail attribute on the source image file. The
+        # source's __dict__ is checked directly, since hasattr() would
+        # trigger the generation of a missing thumbnail.
+        if self.identifier in self.source.__dict__:
             delattr(self.source, self.identifier)
 
         # Clear the image dimensions cache
@@ -151,6 +214,61 @@ class ThumbnailFieldFile(BaseThumbnailFieldFile, ImageProcessor):
     """An ImageFieldFile with image processing capabilities for thumbnails."""
 
 
+class PendingThumbnail(object):
+    """Stands in for a thumbnail that waits in the generation queue.
+    
+    Its ``url`` is the ``THUMBNAILS_PLACEHOLDER_URL`` setting or, if that is
+    not set, the URL of the source image. The dimensions are not known.
+    
+    """
+    
+    pending = True
+    width = None
+    height = None
+    
+    def __init__(self, source, identifier):
+        self.source = source
+        self.identifier = identifier
+    
+    def _get_url(self):
+        if settings.THUMBNAILS_PLACEHOLDER_URL:
+            return settings.THUMBNAILS_PLACEHOLDER_URL
+        return self.source.url
+    url = property(_get_url)
+
+
+
+class ThumbnailURLs(object):
+    """Maps the thumbnail identifiers of a source image to the URLs that
+    ``thumbnail_url()`` returns, so that they can be used in templates::
+    
+        <img src="{{ photo.thumbnail_urls.avatar }}" />
+    
+    """
+    
+    def __init__(self, source):
+        self.source = source
+    
+    def __getitem__(self, identifier):
+        if identifier not in self.source.field.thumbnail_specs:
+            raise KeyError(identifier)
+        return self.source.thumbnail_url(identifier)
+
+
+class ThumbnailSrcsets(ThumbnailURLs):
+    """Maps the thumbnail identifiers of a source image to the values that
+    ``srcset()`` returns, so that they can be used in templates::
+    
+        <img src="{{ photo.thumbnail_urls.avatar }}"
+            srcset="{{ photo.srcsets.avatar }}" />
+    
+    """
+    
+    def __getitem__(self, identifier):
+        if identifier not in self.source.field.thumbnail_specs:
+            raise KeyError(identifier)
+        return self.source.srcset(identifier)
+
 
 class BaseEnhancedImageFieldFile(ImageFieldFile):
     """Enhanced version of the default ImageFieldFile for the source image.
@@ -207,7 +325,7 @@ class BaseEnhancedImageFieldFile(ImageFieldFile):
         # Set the identifier to None. Only thumbnails have an identifier attribute
         self.identifier = None
         # Set the image processing options for this image (source image)
-        self.setup_image_processing_options(field.process_source)
+        self.setup_image_processing_options(field.process_source_spec)
         
         # Among others, also sets ``self.name``
         super(BaseEnhancedImageFieldFile, self).__init__(instance, field, name)
@@ -226,7 +344,7 @@ class BaseEnhancedImageFieldFile(ImageFieldFile):
         if not self._committed:
             # TODO: documentation for this check
             return False
-        elif not self.field.thumbnails:
+        elif not self.field.thumbnail_specs:
             # Check that a dictionary of *thumbnail definitions* has been set
             # on the field.
             return False
@@ -242,9 +360,16 @@ class BaseEnhancedImageFieldFile(ImageFieldFile):
         If a thumbnail attribute is requested, but it has not been set as
         an ``BaseEnhancedImageFieldFile`` instance attribute, then:
         
-        1. Generate the thumbnail
+        1. Generate the thumbnail, unless the manifest or the storage
+           indicate that it already exists
         2. Set it as an ``BaseEnhancedImageFieldFile`` instance attribute
         
+        If thumbnail generation is delayed and ``THUMBNAILS_GENERATION_QUEUE``
+        is set, a missing thumbnail is put on the generation queue instead and
+        a ``PendingThumbnail`` is set as the attribute. The same happens if
+        another process generates the thumbnail and it is not ready within
+        ``THUMBNAILS_LOCK_TIMEOUT`` seconds.
+        
         Developer Notes
         
         Here we use the ``BaseEnhancedImageFieldFile`` instance's __dict__ in
@@ -254,22 +379,179 @@ class BaseEnhancedImageFieldFile(ImageFieldFile):
         A good write-up on this exists at:  http://bit.ly/c2JL8H
         
         """
-        if not self.__dict__.has_key(attribute):
+        if attribute not in self.__dict__:
             # Proceed to thumbnail generation only if a *thumbnail* attribute
             # is requested
-            if self.field.thumbnails.has_key(attribute):
+            if attribute in self.field.thumbnail_specs:
                 # Check thumbnail exists and generate it if need
                 self._require_file()    # TODO: document this
                 if self._verify_thumbnail_requirements():
-                    proc_opts = self.field.thumbnails[attribute]
-                    t = ThumbnailFieldFile(self.instance, self.field, self, self.name, attribute, proc_opts)
-                    if self.storage.exists(smart_unicode(t.name)):
-                        setattr(self, attribute, t)
-                    else:
-                        t.save()
-                    assert self.__dict__[attribute] == t, \
-                        Exception('Thumbnail attribute `%s` not set' % attribute)
-        return self.__dict__[attribute]
+                    queue = None
+                    if settings.THUMBNAILS_DELAYED_GENERATION:
+                        queue = get_generation_queue()
+                    t = self.get_thumbnail(attribute, generate=queue is None)
+                    if t is None:
+                        # Generate the thumbnail in the background or wait
+                        # for the process that holds the lock to generate it
+                        if queue is not None:
+                            queue.enqueue(self, attribute)
+                        setattr(self, attribute, PendingThumbnail(self, attribute))
+        try:
+            return self.__dict__[attribute]
+        except KeyError:
+            raise AttributeError(attribute)
+    
+    def get_thumbnail(self, identifier, generate=True):
+        """Returns the ``ThumbnailFieldFile`` of the thumbnail ``identifier``
+        and sets it as an attribute.
+        
+        The manifest and then the storage are checked for an existing
+        thumbnail. Missing thumbnails are generated, unless ``generate`` is
+        False, in which case None is returned.
+        
+        If ``THUMBNAILS_LOCK_BACKEND`` is set, the thumbnail is generated
+        while holding a lock, so that other processes wait for it instead of
+        generating it too. None is returned if the lock is not acquired
+        within ``THUMBNAILS_LOCK_TIMEOUT`` seconds.
+        
+        The missing density variants of the thumbnail (see the ``densities``
+        option) are generated together with it, so they all share the lock
+        of the 1x variant.
+        
+        """
+        spec = self.field.thumbnail_specs[identifier]
+        t = ThumbnailFieldFile(self.instance, self.field, self, self.name, identifier, spec)
+        if not self._find_thumbnail(t):
+            if not generate:
+                return None
+            lock = get_lock()
+            if lock is None:
+                self._save_thumbnail(identifier, t)
+            else:
+                token = lock.acquire(self._get_lock_key(t), settings.THUMBNAILS_LOCK_TIMEOUT)
+                if token is None:
+                    return None
+                try:
+                    # Another process may have generated it in the meantime
+                    if not self._find_thumbnail(t):
+                        self._save_thumbnail(identifier, t)
+                finally:
+                    lock.release(token)
+        setattr(self, identifier, t)
+        return t
+    
+    def _get_lock_key(self, t):
+        """Returns the key of the generation lock of the thumbnail ``t``,
+        which is the name of its 1x variant if it has density variants."""
+        for density, variant in self.field.thumbnail_densities.get(t.identifier, ()):
+            if density == 1 and variant != t.identifier:
+                spec = self.field.thumbnail_specs[variant]
+                t = ThumbnailFieldFile(self.instance, self.field, self, self.name, variant, spec)
+        return smart_unicode(t.name)
+    
+    def _save_thumbnail(self, identifier, t):
+        """Generates the thumbnail ``t`` and its missing density variants
+        out of a single decode of the source image."""
+        thumbnails = [t]
+        for density, variant in self.field.thumbnail_densities.get(identifier, ()):
+            if variant == identifier or variant in self.__dict__:
+                continue
+            spec = self.field.thumbnail_specs[variant]
+            other = ThumbnailFieldFile(self.instance, self.field, self, self.name, variant, spec)
+            if not self._find_thumbnail(other):
+                thumbnails.append(other)
+        if len(thumbnails) == 1:
+            t.save()
+            return
+        try:
+            content = self.get_image_content()
+        except NoAccessToImage:
+            return
+        try:
+            self._generate_thumbnails(thumbnails, content, close=True)
+        finally:
+            content.close()
+    
+    def _find_thumbnail(self, t):
+        """Checks whether the thumbnail ``t`` exists in the manifest or on
+        the storage and updates it accordingly.
+        
+        Missing thumbnails are recorded in the manifest as well, so that
+        ``thumbnail_url()`` knows that they have to be generated. Such
+        entries may be outdated, since another process may have generated
+        the thumbnail in the meantime, so the storage is still checked.
+        
+        """
+        metric = 'thumbnail_works_thumbnail_lookups_total'
+        entry = manifest.get(self.name, t.identifier, t.spec)
+        if entry is not None and not entry.get('missing'):
+            t.set_metadata(entry)
+            collector.increment(metric, identifier=t.identifier, result='manifest')
+            return True
+        collector.increment('thumbnail_works_storage_exists_total')
+        if self.storage.exists(smart_unicode(t.name)):
+            manifest.set(self.name, t.identifier, t.spec, {'name': t.name})
+            collector.increment(metric, identifier=t.identifier, result='storage')
+            return True
+        manifest.set(self.name, t.identifier, t.spec, {'name': t.name, 'missing': True})
+        collector.increment(metric, identifier=t.identifier, result='missing')
+        return False
+    
+    def thumbnail_url(self, identifier, generate=False):
+        """Returns the URL of the thumbnail ``identifier``.
+        
+        The URL is computed from the name of the source image and the
+        compiled options of the thumbnail, without accessing the storage or
+        constructing a ``ThumbnailFieldFile``. The name recorded in the
+        manifest is used, if there is one.
+        
+        The thumbnail is accessed as an attribute instead, which generates
+        it if it does not exist, if ``generate`` is True or if the manifest
+        records that the thumbnail is missing. This is also the case if the
+        manifest has no entry and it is not shared between processes (see
+        ``THUMBNAILS_MANIFEST_CACHE``), since another process may or may not
+        have generated the thumbnail.
+        
+        """
+        if identifier in self.__dict__:
+            return self.__dict__[identifier].url
+        try:
+            spec = self.field.thumbnail_specs[identifier]
+        except KeyError:
+            raise ThumbnailWorksError('Unknown thumbnail: %s' % identifier)
+        self._require_file()
+        if not generate:
+            entry = manifest.get(self.name, spec.identifier, spec)
+            if entry is None:
+                if manifest.shared:
+                    # Thumbnails are recorded when they are generated
+                    return self.storage.url(smart_unicode(spec.get_image_name(self.name)))
+            elif not entry.get('missing'):
+                return self.storage.url(smart_unicode(entry['name']))
+        return getattr(self, identifier).url
+    
+    def _get_thumbnail_urls(self):
+        return ThumbnailURLs(self)
+    thumbnail_urls = property(_get_thumbnail_urls)
+    
+    def srcset(self, identifier):
+        """Returns the value of the ``srcset`` attribute of an ``<img>``
+        element for the density variants of the thumbnail ``identifier``,
+        eg ``/media/thumbs/photo.avatar.jpg 1x, /media/thumbs/photo.avatar@2x.jpg 2x``.
+        
+        The URLs are returned by ``thumbnail_url()``, so the storage is not
+        accessed for thumbnails that are not known to be missing.
+        
+        """
+        if identifier not in self.field.thumbnail_specs:
+            raise ThumbnailWorksError('Unknown thumbnail: %s' % identifier)
+        variants = self.field.thumbnail_densities.get(identifier, [(1, identifier)])
+        return ', '.join(['%s %gx' % (self.thumbnail_url(variant), density)
+            for density, variant in variants])
+    
+    def _get_srcsets(self):
+        return ThumbnailSrcsets(self)
+    srcsets = property(_get_srcsets)
     
     def save(self, name, content, save=True):
         """Saves the source image and generates thumbnails.
@@ -282,6 +564,9 @@ class BaseEnhancedImageFieldFile(ImageFieldFile):
         If the image processing options have been set, then the source image
         is processed before it is finally saved to the storage.
         
+        The thumbnails are recorded as missing in the manifest, which also
+        replaces the entries of a previous image of the same name.
+        
         After the source file is saved, if the ``THUMBNAILS_DELAYED_GENERATION``
         setting has been enabled, no thumbnails are generated. The thumbnails
         will be generated the first time they are accessed.
@@ -289,43 +574,237 @@ class BaseEnhancedImageFieldFile(ImageFieldFile):
         If ``THUMBNAILS_DELAYED_GENERATION`` is set to False, then all thumbnails
         are generated as soon as the source image is saved.
         
+        If the field is ``content_addressed``, the source image is named after
+        its content (see ``get_content_name()``). If an image of that name
+        exists on the storage already, it is used as it is, without processing
+        and saving the image again. Thumbnails that exist already are not
+        generated again.
+        
         """
+        content_addressed = self.field.content_addressed
+        if content_addressed:
+            name = self.get_content_name(name, content)
+            if self._use_existing_image(name, save):
+                if not settings.THUMBNAILS_DELAYED_GENERATION:
+                    self.generate_missing_thumbnails()
+                return
         
         # Resize the source image if image processing options have been set
+        backend = get_backend(self.field.processing_backend)
+        processed_content = None
         if self.proc_opts is not None:
             try:
-                content = self.process_image(content)
+                content = processed_content = backend.process_images([self], content)[0]
             except NoAccessToImage:
                 pass
             # The following sets the correct filename extension according
             # to the image format. 
             name = self.generate_image_name(name=name)
         
-        # Save the source image on the storage.
-        # This also re-sets ``self.name``
-        super(BaseEnhancedImageFieldFile, self).save(name, content, save)
+        try:
+            # Save the source image on the storage.
+            # This also re-sets ``self.name``
+            super(BaseEnhancedImageFieldFile, self).save(name, content, save)
+            self._record_missing_thumbnails()
+            
+            if settings.THUMBNAILS_DELAYED_GENERATION:
+                # Thumbnails will be generated on first access
+                return
+            
+            # Generate all thumbnails
+            if self._verify_thumbnail_requirements():
+                thumbnails = []
+                for identifier, spec in self.field.thumbnail_specs.items():
+                    thumbnails.append(ThumbnailFieldFile(self.instance, self.field, self, self.name, identifier, spec))
+                if content_addressed:
+                    # The thumbnails of identical images may exist already
+                    thumbnails = [t for t in thumbnails if not self._find_thumbnail(t)]
+                if thumbnails:
+                    self._generate_thumbnails(thumbnails, content)
+        finally:
+            # Release the processed source image data
+            if processed_content is not None:
+                processed_content.close()
+    
+    def _record_missing_thumbnails(self):
+        """Records the thumbnails of a newly saved image as missing in the
+        manifest, so that ``thumbnail_url()`` generates them. This also
+        replaces the entries that a previous image of the same name may have
+        left behind, for example if it was deleted by another process."""
+        for spec in self.field.thumbnail_specs.values():
+            manifest.set(self.name, spec.identifier, spec,
+                {'name': spec.get_image_name(self.name), 'missing': True})
+    
+    def get_content_name(self, name, content):
+        """Returns the file name of the source image of a content addressed
+        field.
         
-        if settings.THUMBNAILS_DELAYED_GENERATION:
-            # Thumbnails will be generated on first access
-            return
+        The name is the SHA-1 hex digest of the data in ``content`` and, if
+        the source image is processed, of its image processing options,
+        followed by the extension the image is saved with.
         
-        # Generate all thumbnails
-        if self._verify_thumbnail_requirements():
-            for identifier, proc_opts in self.field.thumbnails.items():
-                t = ThumbnailFieldFile(self.instance, self.field, self, self.name, identifier, proc_opts)
-                t.save(content)
+        """
+        digest = sha1()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        content.seek(0)
+        if self.spec is not None:
+            digest.update(self.spec.digest.encode('ascii'))
+            ext = self.spec.extension
+        else:
+            ext = os.path.splitext(name)[1].lower()
+        return digest.hexdigest() + ext
+    
+    def _use_existing_image(self, name, save):
+        """Points the field to the existing image ``name`` instead of saving
+        the image again. Returns False if the image does not exist."""
+        name = self.field.generate_filename(self.instance, name)
+        if not self.storage.exists(name):
+            return False
+        self.name = name
+        setattr(self.instance, self.field.name, self.name)
+        self._committed = True
+        if save:
+            self.instance.save()
+        return True
+    
+    def _is_shared(self):
+        """Checks whether other objects refer to the same image, which
+        happens with content addressed fields."""
+        model = getattr(self.field, 'model', None)
+        if model is None:
+            return False
+        others = model._default_manager.filter(**{self.field.name: self.name})
+        if self.instance.pk is not None:
+            others = others.exclude(pk=self.instance.pk)
+        return others.exists()
+    
+    def generate_missing_thumbnails(self, identifiers=None):
+        """Generates the thumbnails that do not exist yet.
+        
+        ``identifiers``
+            The identifiers of the thumbnails to check. Defaults to all the
+            thumbnails of the field.
+        
+        The source image is read and decoded only once for all the missing
+        thumbnails. Returns the number of generated thumbnails.
+        
+        """
+        if not self._verify_thumbnail_requirements():
+            return 0
+        if identifiers is None:
+            identifiers = self.field.thumbnail_specs.keys()
+        missing = []
+        for identifier in identifiers:
+            if self.get_thumbnail(identifier, generate=False) is None:
+                spec = self.field.thumbnail_specs[identifier]
+                missing.append(ThumbnailFieldFile(self.instance, self.field, self, self.name, identifier, spec))
+        if missing:
+            content = self.get_image_content()
+            try:
+                self._generate_thumbnails(missing, content, close=True)
+            finally:
+                content.close()
+        return len(missing)
+    
+    def _generate_found_missing(self, thumbnails):
+        """Generates the ``thumbnails``, which have been found missing, out
+        of a single decode of the source image.
+        
+        As with thumbnail attributes, the thumbnails are put on the
+        generation queue instead if ``THUMBNAILS_DELAYED_GENERATION`` and
+        ``THUMBNAILS_GENERATION_QUEUE`` are set, and they are generated while
+        holding their locks if ``THUMBNAILS_LOCK_BACKEND`` is set. Thumbnails
+        whose locks are not acquired are skipped.
+        
+        Returns the number of generated thumbnails. Nothing is generated if
+        the source image cannot be read.
+        
+        """
+        queue = None
+        if settings.THUMBNAILS_DELAYED_GENERATION:
+            queue = get_generation_queue()
+        if queue is not None:
+            for t in thumbnails:
+                queue.enqueue(self, t.identifier)
+                setattr(self, t.identifier, PendingThumbnail(self, t.identifier))
+            return 0
+        lock = get_lock()
+        tokens = {}
+        try:
+            if lock is not None:
+                locked = []
+                for t in thumbnails:
+                    # Density variants share a lock, which is acquired once
+                    key = self._get_lock_key(t)
+                    if key not in tokens:
+                        tokens[key] = lock.acquire(key, settings.THUMBNAILS_LOCK_TIMEOUT)
+                    if tokens[key] is None:
+                        continue
+                    # Another process may have generated it in the meantime
+                    if self._find_thumbnail(t):
+                        setattr(self, t.identifier, t)
+                    else:
+                        locked.append(t)
+                thumbnails = locked
+            if not thumbnails:
+                return 0
+            try:
+                content = self.get_image_content()
+            except NoAccessToImage:
+                return 0
+            try:
+                self._generate_thumbnails(thumbnails, content, close=True)
+            finally:
+                content.close()
+            return len(thumbnails)
+        finally:
+            for token in tokens.values():
+                if token is not None:
+                    lock.release(token)
+    
+    def _generate_thumbnails(self, thumbnails, content, close=False):
+        """Generates and saves ``thumbnails`` out of the source image data
+        ``content``. The source image is decoded only once. If ``close`` is
+        True, ``content`` is closed as soon as it has been decoded."""
+        backend = get_backend(self.field.processing_backend)
+        started = time.time()
+        contents = backend.process_images(thumbnails, content, close=close)
+        def save_thumbnail(args):
+            t, thumbnail_content = args
+            # The generation latency includes the processing of the batch
+            t.save(thumbnail_content=thumbnail_content, started=started)
+        run_tasks(save_thumbnail, zip(thumbnails, contents))
     
     def delete(self, save=True):
         """Deletes the thumbnails and the source image.
         
         If the files are missing from the storage, no errors are raised.
         
+        If the field is ``content_addressed`` and other objects of the model
+        refer to the same image, the files are kept and only the reference
+        to them is removed.
+        
         """
+        if self.field.content_addressed and self.name and self._is_shared():
+            if hasattr(self, '_file'):
+                self.close()
+                del self.file
+            if hasattr(self, '_dimensions_cache'):
+                del self._dimensions_cache
+            self.name = None
+            setattr(self.instance, self.field.name, self.name)
+            self._committed = False
+            if save:
+                self.instance.save()
+            return
+        
         # First try to delete the thumbnails
         if self._verify_thumbnail_requirements():
-            for identifier, proc_opts in self.field.thumbnails.items():
-                t = ThumbnailFieldFile(self.instance, self.field, self, self.name, identifier, proc_opts)
-                t.delete()
+            thumbnails = []
+            for identifier, spec in self.field.thumbnail_specs.items():
+                thumbnails.append(ThumbnailFieldFile(self.instance, self.field, self, self.name, identifier, spec))
+            run_tasks(lambda t: t.delete(), thumbnails)
         
         # Delete the source file
         super(BaseEnhancedImageFieldFile, self).delete(save)
@@ -354,6 +833,11 @@ class EnhancedImageFieldFile(BaseEnhancedImageFieldFile, ImageProcessor):
             height="{{ photo.avatar.height }}"
             alt='{{ user.name }}' />
     
+    If only the URL of a thumbnail is needed, ``photo.thumbnail_url('avatar')``
+    or ``{{ photo.thumbnail_urls.avatar }}`` in templates return it without
+    accessing the storage. Thumbnails that the manifest knows to be missing
+    are generated, as when they are accessed as attributes.
+    
     """
 
 
@@ -422,7 +906,77 @@ class EnhancedImageField(ImageField):
                 (PIL). If it is not set, then the default format specified by
                 the ``THUMBNAILS_FORMAT`` setting will be used. In case the
                 format is set to ``JPEG``, the value of the ``THUMBNAILS_QUALITY``
-                is used as the quality when the image is saved.
+                is used as the quality when the image is saved. The file
+                extension is derived from the format, eg ``.jpg``, ``.png``,
+                ``.webp`` or ``.avif``.
+            ``encoder_options``
+                A dictionary of options that are passed to the PIL encoder
+                of the format, eg ``dict(quality=70, progressive=True,
+                optimize=True)`` for JPEG, ``dict(compress_level=9)`` for PNG
+                or ``dict(quality=80, method=6)`` for WebP. They override the
+                ``THUMBNAILS_ENCODER_OPTIONS`` setting of the format.
+            ``strip_metadata``
+                Boolean option. By default, the EXIF data and the ICC color
+                profile of the source image are not saved with the thumbnail.
+                If this is set to ``False``, they are kept.
+            ``densities``
+                A sequence of pixel densities, eg ``(1.5, 2, 3)``. For each
+                density other than 1, a variant of the thumbnail named
+                ``<identifier>@<density>x`` (eg ``avatar@2x``) is also
+                generated, with the ``size`` (and ``max_bytes``) scaled
+                accordingly. The variants are generated together with the
+                thumbnail out of a single decode of the source image. The
+                ``srcset()`` method of the source image returns the value of
+                the ``srcset`` attribute of the ``<img>`` element.
+            ``max_bytes``
+                The maximum size of the thumbnail data, as a number of bytes
+                or a string such as ``30KB``. The thumbnail is saved with the
+                highest quality, up to the configured one, that keeps it
+                within this size. It is only used for the JPEG, WEBP and AVIF
+                formats. If no quality fits, the smallest result is used.
+            ``resample``
+                The filter the image is resized with: ``lanczos`` (the
+                default), ``bicubic``, ``bilinear``, ``box`` or ``nearest``.
+            ``speed``
+                Either ``quality`` (the default), ``balanced`` or ``fast``.
+                Unless it is ``quality``, images that are much bigger than
+                the thumbnail are first reduced by an integer factor
+                (``balanced``) or with the nearest neighbour filter
+                (``fast``) to a few times the size of the thumbnail, and only
+                then resized with the ``resample`` filter. This is much
+                faster for small thumbnails of large images, eg
+                ``dict(size='64x64', crop=True, resample='bicubic', speed='fast')``
+                for avatars. It works with every crop mode.
+            ``passthrough``
+                Boolean option. By default, if the image data is already in
+                the requested ``format``, it would not be resized, cropped,
+                rotated by its EXIF orientation or converted, it fits in
+                ``max_bytes`` and it has no metadata that would be stripped,
+                it is saved as it is instead of being decoded and encoded
+                again. Only the header of the image is read to decide. This
+                never happens if the ``sharpen``, ``detail`` or
+                ``encoder_options`` options are set, if this option is set
+                to ``False`` or if the image has other metadata than the EXIF
+                data and the ICC profile, such as XMP or IPTC data.
+    ``content_addressed``
+        If set, the source image is named after the SHA-1 digest of its data
+        and the names of the thumbnails also contain a digest of their image
+        processing options. Uploading an image that exists already reuses the
+        stored image and its thumbnails instead of processing and storing
+        them again. Images that are shared by several objects are deleted
+        only together with the last of them. If it is not set, the
+        ``THUMBNAILS_CONTENT_ADDRESSED`` setting is used.
+    ``processing_backend``
+        The dotted path to the class that processes the source image and
+        generates the thumbnails when the source image is saved. If it is not
+        set, the ``THUMBNAILS_PROCESSING_BACKEND`` setting is used. The
+        available backends are:
+        
+        ``thumbnail_works.backends.InProcessBackend``
+            Processes the images in the current process (the default).
+        ``thumbnail_works.backends.ProcessPoolBackend``
+            Processes the images in a pool of worker processes. This is
+            suitable for large source images.
     
     The following code snippet illustrates how to use the ``EnhancedImageField``::
 
@@ -443,8 +997,35 @@ class EnhancedImageField(ImageField):
     """
     attr_class = EnhancedImageFieldFile
     
-    def __init__(self, process_source=None, thumbnails={}, **kwargs):
+    def __init__(self, process_source=None, thumbnails={}, processing_backend=None,
+            content_addressed=None, **kwargs):
         self.process_source = process_source
         self.thumbnails = thumbnails
+        self.processing_backend = processing_backend
+        if content_addressed is None:
+            content_addressed = settings.THUMBNAILS_CONTENT_ADDRESSED
+        self.content_addressed = content_addressed
+        
+        # Compile the image processing options once for all the images
+        default_options = self.attr_class.DEFAULT_OPTIONS
+        self.process_source_spec = None
+        if process_source is not None:
+            self.process_source_spec = ImageSpec(None, process_source, default_options)
+        self.thumbnail_specs = {}
+        # The (density, identifier) variants of each thumbnail with densities
+        self.thumbnail_densities = {}
+        for identifier, proc_opts in thumbnails.items():
+            spec = ImageSpec(identifier, proc_opts, default_options, content_addressed)
+            variants = []
+            for density, variant_spec in spec.get_variants():
+                variant = identifier
+                if variant_spec is not spec:
+                    variant = '%s@%gx' % (identifier, density)
+                self.thumbnail_specs[variant] = variant_spec
+                variants.append((density, variant))
+            if len(variants) > 1:
+                for density, variant in variants:
+                    self.thumbnail_densities[variant] = variants
+        
         super(EnhancedImageField, self).__init__(**kwargs)
 
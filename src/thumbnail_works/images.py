@@ -1,10 +1,11 @@
 
+import json
+import math
 import os
+from collections import namedtuple
+from hashlib import md5
+from tempfile import SpooledTemporaryFile
 
-try:
-    from cStringIO import StringIO
-except ImportError:
-    from StringIO import StringIO
 try:
     from PIL import Image, ImageFilter
 except ImportError:
@@ -13,13 +14,292 @@ except ImportError:
 
 from cropresize2 import CM_AUTO, crop_resize
 
-from django.core.files.base import ContentFile
+from django.core.files.base import File
 
 from thumbnail_works import settings
 
 from thumbnail_works.exceptions import ThumbnailOptionError, ThumbnailWorksError, NoAccessToImage
-from thumbnail_works.utils import get_width_height_from_string
+from thumbnail_works.exceptions import ImageTooLargeError
+from thumbnail_works.metrics import collector
+from thumbnail_works.signals import start_stage, end_stage
+from thumbnail_works.utils import ReadOnlyDict, get_bytes_from_string, get_width_height_from_string
+from thumbnail_works.workers import run_tasks
+
+
+
+class ImageContent(File):
+    """A File of processed image data.
+    
+    The data is kept in the file object it was encoded to, so it is never
+    copied into a string. The ``size`` of the data is known in advance.
+    
+    Also carries the ``image_size`` (width, height) and the ``image_format``
+    of the image, so that they do not have to be read from the data again.
+    
+    """
+    
+    def __init__(self, file, image_size, image_format):
+        super(ImageContent, self).__init__(file)
+        file.seek(0, 2)
+        self.size = file.tell()
+        file.seek(0)
+        self.image_size = image_size
+        self.image_format = image_format
+
+
+# The filters of the ``resample`` option
+RESAMPLE_FILTERS = {
+    'nearest': Image.NEAREST,
+    'bilinear': Image.BILINEAR,
+    'bicubic': Image.BICUBIC,
+    'lanczos': getattr(Image, 'LANCZOS', None) or Image.ANTIALIAS,
+    }
+if hasattr(Image, 'BOX'):
+    RESAMPLE_FILTERS['box'] = Image.BOX
+
+# The pre-reduction of the ``speed`` option: (method, gap). Images are first
+# reduced with ``method`` to no less than ``gap`` times the final size.
+SPEED_PROFILES = {
+    'quality': (None, None),
+    'balanced': ('reduce', 3),
+    'fast': ('nearest', 2),
+    }
 
+# The metadata of the source images that thumbnails do not keep by default
+METADATA_KEYS = ('exif', 'icc_profile', 'xmp', 'comment', 'photoshop')
+
+# The metadata that is kept if strip_metadata is False, see get_metadata_options()
+KEPT_METADATA_KEYS = ('exif', 'icc_profile')
+
+# The JPEG APPn segments that do not hold other metadata than the kept one,
+# by marker and the prefix of their data
+PLAIN_APP_SEGMENTS = (
+    ('APP0', b'JFIF\0'),
+    ('APP0', b'JFXX\0'),
+    ('APP1', b'Exif\0'),
+    ('APP2', b'ICC_PROFILE\0'),
+    )
+
+# The quality the formats that support ``max_bytes`` are saved with by default
+DEFAULT_QUALITY = {
+    'JPEG': 75,
+    'WEBP': 80,
+    'AVIF': 75,
+    }
+
+# File extensions of the formats, if they differ from the format name
+EXTENSIONS = {
+    'jpeg': '.jpg',
+    }
+
+
+def clean_identifier(identifier):
+    """Checks the identifier of a thumbnail and returns it in the form
+    that is used in attribute and file names."""
+    if not isinstance(identifier, str):
+        raise ThumbnailOptionError('The identifier must be a string')
+    elif identifier == '':
+        raise ThumbnailOptionError('The identifier must be set to something on thumbnails')
+    return identifier.replace(' ', '_')
+
+
+def get_extension(format):
+    """Returns the file extension of the image ``format``."""
+    ext = format.lower()
+    return EXTENSIONS.get(ext, '.%s' % ext)
+
+
+def get_save_options(format, encoder_options=None):
+    """Returns the keyword arguments of ``Image.save()`` for ``format``.
+    
+    JPEG images are saved with ``THUMBNAILS_QUALITY``. The options of the
+    format in ``THUMBNAILS_ENCODER_OPTIONS`` and then ``encoder_options``
+    are applied on top of that.
+    
+    """
+    options = {}
+    if format == 'JPEG':
+        options['quality'] = settings.THUMBNAILS_QUALITY
+    options.update(settings.THUMBNAILS_ENCODER_OPTIONS.get(format, {}))
+    if encoder_options:
+        options.update(encoder_options)
+    return options
+
+
+def get_metadata_options(metadata):
+    """Returns the keyword arguments of ``Image.save()`` that keep the
+    EXIF data and the ICC profile in ``metadata``.
+    
+    The EXIF orientation is reset, since the image has been rotated already.
+    EXIF data is dropped if it cannot be edited with the installed PIL.
+    
+    """
+    options = {}
+    if metadata.get('icc_profile'):
+        options['icc_profile'] = metadata['icc_profile']
+    if metadata.get('exif') and hasattr(Image, 'Exif'):
+        exif = Image.Exif()
+        exif.load(metadata['exif'])
+        if exif.get(0x0112, 1) != 1:
+            exif[0x0112] = 1
+        options['exif'] = exif.tobytes()
+    return options
+
+
+# Options that do not change the generated image, see get_digest()
+DIGEST_IGNORED_OPTIONS = ('densities',)
+
+
+def get_digest(proc_opts, default_options):
+    """Returns a digest of the image processing options.
+    
+    Only the options in ``proc_opts`` that change the generated image and
+    differ from ``default_options`` are hashed, so that the digest does not
+    change when an option is added with a default value. The format is always
+    hashed, since its default is a setting. The options are serialized as
+    JSON with sorted keys, so that str and unicode values are hashed alike.
+    
+    """
+    options = {}
+    for name, value in proc_opts.items():
+        if name in DIGEST_IGNORED_OPTIONS:
+            continue
+        if name != 'format' and name in default_options and value == default_options[name]:
+            continue
+        options[name] = value
+    data = json.dumps(options, sort_keys=True, default=repr)
+    return md5(data.encode('utf-8')).hexdigest()
+
+
+class ImageSpec(object):
+    """Image processing options compiled for repeated use.
+    
+    ``identifier``
+        The thumbnail identifier, or None for the source image.
+    ``proc_opts``
+        A dictionary of image processing options.
+    ``default_options``
+        The default values of the options. Defaults to
+        ``ImageProcessor.DEFAULT_OPTIONS``.
+    ``content_addressed``
+        If True, the names of thumbnails also contain the first eight
+        characters of the ``digest`` of the options, so that thumbnails
+        with different options never share a name.
+    
+    The options are checked and merged with the default options, and the
+    ``size`` tuple, ``max_bytes``, the file ``extension``, the ``save_options`` of the
+    encoder, the ``name_template`` of the image files and the ``digest`` of
+    the options are computed once.
+    ``EnhancedImageField`` compiles its specs when it is defined and shares
+    them between all its images, so specs cannot be modified. Their
+    ``proc_opts`` and ``save_options`` are read-only copies (see
+    ``ReadOnlyDict``), with the ``densities`` as a tuple.
+    
+    """
+    
+    __slots__ = ('identifier', 'proc_opts', 'content_addressed', 'size',
+        'max_bytes', 'extension', 'save_options', 'name_template', 'digest')
+    
+    def __init__(self, identifier, proc_opts, default_options=None, content_addressed=False):
+        if identifier is not None:
+            identifier = clean_identifier(identifier)
+        if proc_opts is None and identifier is not None:
+            raise ThumbnailOptionError('It is not possible to set the \
+                image processing options to None on thumbnails')
+        elif not isinstance(proc_opts, dict):
+            raise ThumbnailOptionError('A dictionary object is required')
+        if default_options is None:
+            default_options = ImageProcessor.DEFAULT_OPTIONS
+        for option in proc_opts.keys():
+            if option not in default_options:
+                raise ThumbnailOptionError('Invalid thumbnail option `%s`' % option)
+        options = dict(default_options)
+        options.update(proc_opts)
+        if options['encoder_options'] is not None:
+            options['encoder_options'] = ReadOnlyDict(options['encoder_options'])
+        
+        size = None
+        if options['size'] is not None:
+            size = get_width_height_from_string(options['size'])
+        max_bytes = None
+        if options['max_bytes'] is not None:
+            max_bytes = get_bytes_from_string(options['max_bytes'])
+        if options['resample'] not in RESAMPLE_FILTERS:
+            raise ThumbnailOptionError('resample must be one of: %s' % ', '.join(sorted(RESAMPLE_FILTERS)))
+        if options['speed'] not in SPEED_PROFILES:
+            raise ThumbnailOptionError('speed must be one of: %s' % ', '.join(sorted(SPEED_PROFILES)))
+        if options['densities'] is not None:
+            if size is None:
+                raise ThumbnailOptionError('The densities option requires the size option')
+            try:
+                densities = [float(density) for density in options['densities']]
+            except (TypeError, ValueError):
+                raise ThumbnailOptionError('densities must be a sequence of numbers')
+            if [density for density in densities if density <= 0]:
+                raise ThumbnailOptionError('densities must be positive numbers')
+            options['densities'] = tuple(options['densities'])
+        extension = get_extension(options['format'])
+        save_options = ReadOnlyDict(get_save_options(options['format'], options['encoder_options']))
+        # Compared with the built-in defaults, since variants pass their
+        # merged options as the defaults
+        digest = get_digest(options, ImageProcessor.DEFAULT_OPTIONS)
+        if identifier is None:
+            name_template = '%s' + extension
+        elif content_addressed:
+            name_template = '%s.' + identifier.replace('%', '%%') + '.' + digest[:8] + extension
+        else:
+            name_template = '%s.' + identifier.replace('%', '%%') + extension
+        
+        for name, value in (('identifier', identifier), ('proc_opts', ReadOnlyDict(options)),
+                ('content_addressed', content_addressed),
+                ('size', size), ('max_bytes', max_bytes), ('extension', extension),
+                ('save_options', save_options),
+                ('name_template', name_template), ('digest', digest)):
+            object.__setattr__(self, name, value)
+    
+    def get_variants(self):
+        """Returns a list of (density, spec) tuples for the ``densities``
+        option, sorted by density, starting with this spec as the 1x variant.
+        
+        The other variants are thumbnails with the identifier
+        ``<identifier>@<density>x``, whose ``size`` and ``max_bytes`` are
+        scaled by the density and the density squared respectively.
+        
+        """
+        variants = [(1, self)]
+        if not self.proc_opts['densities']:
+            return variants
+        width, height = self.size
+        for density in sorted(set(self.proc_opts['densities'])):
+            if density == 1:
+                continue
+            proc_opts = dict(self.proc_opts, densities=None,
+                size='%dx%d' % (round(width * density), round(height * density)))
+            if self.max_bytes is not None:
+                proc_opts['max_bytes'] = int(self.max_bytes * density * density)
+            identifier = '%s@%gx' % (self.identifier, density)
+            variants.append((density, ImageSpec(identifier, proc_opts, proc_opts,
+                self.content_addressed)))
+        variants.sort(key=lambda variant: variant[0])
+        return variants
+    
+    def get_image_name(self, name):
+        """Returns the name of the image file that is generated out of the
+        source image ``name`` (see ``ImageProcessor.generate_image_name()``)."""
+        root_dir, filename = os.path.split(name)
+        image_filename = self.name_template % os.path.splitext(filename)[0]
+        if self.identifier is not None and settings.THUMBNAILS_DIRNAME:
+            return os.path.join(root_dir, settings.THUMBNAILS_DIRNAME, image_filename)
+        return os.path.join(root_dir, image_filename)
+    
+    def __setattr__(self, name, value):
+        raise AttributeError('ImageSpec objects cannot be modified')
+    
+    def __reduce__(self):
+        return (self.__class__, (self.identifier, self.proc_opts, None, self.content_addressed))
+    
+    def __repr__(self):
+        return '<ImageSpec: %s %r>' % (self.identifier, self.proc_opts)
 
 
 class ImageProcessor:
@@ -28,9 +308,11 @@ class ImageProcessor:
     Required instance attributes::
     
         self.identifier
-        self.proc_opts
         self.name
         self.storage
+    
+    ``setup_image_processing_options()`` sets ``self.spec`` and
+    ``self.proc_opts``.
         
     """
     
@@ -41,12 +323,29 @@ class ImageProcessor:
         'upscale': False,
         'crop': CM_AUTO,
         'format': settings.THUMBNAILS_FORMAT,
+        'encoder_options': None,
+        'strip_metadata': True,
+        'max_bytes': None,
+        'densities': None,
+        'resample': 'lanczos',
+        'speed': 'quality',
+        'passthrough': True,
         }
     
+    # See can_derive_from()
+    DERIVE_RATIO = 2
+    
+    # See encode_image()
+    MAX_BYTES_ENCODES = 6
+    MIN_QUALITY = 10
+    
     def setup_image_processing_options(self, proc_opts):
         """Sets the image processing options as an attribute of the
         ImageFieldFile instance.
         
+        ``proc_opts`` is either a dictionary of options or an already
+        compiled ``ImageSpec``, which is set as ``self.spec``.
+        
         If ``proc_opts`` is ``None``, then ``self.proc_opts`` is also set to
         ``None``. This is allowed in favor of the source image which may not be
         processed.
@@ -60,29 +359,24 @@ class ImageProcessor:
             if self.identifier is not None: # self is a thumbnail
                 raise ThumbnailOptionError('It is not possible to set the \
                     image processing options to None on thumbnails')
+            self.spec = None
             self.proc_opts = None
-        elif not isinstance(proc_opts, dict):
-            raise ThumbnailOptionError('A dictionary object is required')
-        else:
-            for option in proc_opts.keys():
-                if option not in self.DEFAULT_OPTIONS.keys():
-                    raise ThumbnailOptionError('Invalid thumbnail option `%s`' % option)
-            self.proc_opts = self.DEFAULT_OPTIONS.copy()
-            self.proc_opts.update(proc_opts)
+            return
+        if not isinstance(proc_opts, ImageSpec):
+            proc_opts = ImageSpec(self.identifier, proc_opts, self.DEFAULT_OPTIONS)
+        self.spec = proc_opts
+        # The options of the spec are shared, so the processor gets a copy
+        self.proc_opts = dict(proc_opts.proc_opts)
     
     def get_image_extension(self):
         """Returns the extension in accordance to the image format.
         
-        If the image processing options ``self.proc_opts`` is not a dict,
-        None is returned.
+        If there are no image processing options, None is returned.
         
         """
-        if not isinstance(self.proc_opts, dict):
-            return
-        ext = self.proc_opts['format'].lower()
-        if ext == 'jpeg':
-            return '.jpg'
-        return '.%s' % ext
+        if self.spec is None:
+            return None
+        return self.spec.extension
     
     def generate_image_name(self, name, force_ext=None):
         """Generates a path for the image file taking the format into account.
@@ -114,57 +408,170 @@ class ImageProcessor:
         """
         if not name:
             raise ThumbnailWorksError('The provided name is not usable: "%s"')
+        if force_ext is None and self.spec is not None:
+            return self.spec.get_image_name(name)
         root_dir = os.path.dirname(name)  # images
         filename = os.path.basename(name)    # photo.jpg
         base_filename, default_ext = os.path.splitext(filename)
-        if force_ext is not None:
-            ext = force_ext
-        else:
-            ext = self.get_image_extension()
-            if ext is None:
-                ext = default_ext
+        ext = force_ext
+        if ext is None:
+            ext = default_ext
         if self.identifier is None: # For source images
             image_filename = '%s%s' % (base_filename, ext)
-            return os.path.join(root_dir, image_filename)
         else:   # For thumbnails
             image_filename = '%s.%s%s' % (base_filename, self.identifier, ext)
-            if settings.THUMBNAILS_DIRNAME:
-                return os.path.join(root_dir, settings.THUMBNAILS_DIRNAME, image_filename)
-            return os.path.join(root_dir, image_filename)
+        if self.identifier is not None and settings.THUMBNAILS_DIRNAME:
+            return os.path.join(root_dir, settings.THUMBNAILS_DIRNAME, image_filename)
+        return os.path.join(root_dir, image_filename)
     
     def get_image_content(self):
-        """Returns the image data as a ContentFile."""
+        """Returns the image data as a File object.
+        
+        Files that the storage opens from the local filesystem are returned
+        as they are. The data of other files is copied in chunks to a
+        temporary file, which is kept in memory only up to
+        ``THUMBNAILS_SPOOL_MAX_SIZE`` bytes.
+        
+        The caller should close the returned file once the image has been
+        decoded.
+        
+        """
+        start = start_stage()
         try:
-            content = ContentFile(self.storage.open(self.name).read())
+            f = self.storage.open(self.name)
         except IOError:
+            collector.increment('thumbnail_works_no_access_to_image_total')
             raise NoAccessToImage()
+        try:
+            f.file.fileno()
+        except (AttributeError, IOError, ValueError):
+            pass
         else:
-            return content
+            end_stage(self, 'read', start)
+            return f
+        spool = SpooledTemporaryFile(max_size=settings.THUMBNAILS_SPOOL_MAX_SIZE)
+        try:
+            for chunk in f.chunks():
+                spool.write(chunk)
+        except IOError:
+            spool.close()
+            collector.increment('thumbnail_works_no_access_to_image_total')
+            raise NoAccessToImage()
+        finally:
+            f.close()
+        spool.seek(0)
+        end_stage(self, 'read', start)
+        return File(spool, name=self.name)
     
-    def process_image(self, content=None):
-        """Processes and returns the image data."""
+    def open_image(self, content=None, processors=None, close=False):
+        """Decodes the image data and returns a PIL image ready for processing.
+        
+        ``content``
+            The image data. If not set, the data is read from the storage.
+        ``processors``
+            A list of the ``ImageProcessor`` instances that are going to
+            process the decoded image. Defaults to this image processor only.
+        ``close``
+            If True, ``content`` is closed as soon as the image has been
+            decoded.
+        
+        JPEG images are decoded at the smallest scale that is suitable for
+        all ``processors`` (see ``get_draft_size()``).
+        
+        Images that exceed ``THUMBNAILS_MAX_PIXELS`` or need more memory than
+        ``THUMBNAILS_MEMORY_BUDGET`` to be decoded are decoded at a scale
+        that is still big enough for all ``processors``, if they are JPEG
+        images. Otherwise, ``ImageTooLargeError`` is raised before decoding.
+        The memory of the pixels is set as the ``memory_usage`` attribute of
+        all ``processors``: ``estimated`` before decoding, from the header,
+        and ``decoded``, computed from the size and mode of the decoded image
+        and its converted copy. Neither includes the memory of the decoder
+        itself.
         
+        The image is converted to a mode supported by the processors and it
+        is rotated according to its EXIF orientation data.
+        
+        If the image data is read from the storage, the file is closed as
+        soon as the image has been decoded.
+        
+        The dimensions of the image data are set as the ``source_size``
+        attribute of all ``processors``.
+        
+        """
+        close_content = close or content is None
         if content is None:
             content = self.get_image_content()
+        if processors is None:
+            processors = [self]
+        
+        start = start_stage()
+        try:
+            # Image.open() accepts a file-like object, but it is needed
+            # to rewind it back to be able to get the data,
+            content.seek(0)
+            im = Image.open(content)
+            source_size = im.size
+            metadata = {}
+            for key in ('exif', 'icc_profile'):
+                if im.info.get(key):
+                    metadata[key] = im.info[key]
+            
+            # Use reduced-resolution (DCT scaled) decoding if possible
+            if im.format == 'JPEG':
+                draft_size = self._get_budget_draft_size(im, processors)
+                if draft_size is not None:
+                    im.draft(im.mode, draft_size)
+            
+            # Refuse to decode images that exceed the limits
+            estimated = get_memory_estimate(im.size, im.mode)
+            self._check_limits(im.size, estimated)
+            
+            # Decode now, so that the image data is not needed any more
+            im.load()
+        finally:
+            if close_content:
+                content.close()
         
-        # Image.open() accepts a file-like object, but it is needed
-        # to rewind it back to be able to get the data,
-        content.seek(0)
-        im = Image.open(content)
+        decoded = get_memory_estimate(im.size, im.mode, convert=False)
         
         # Convert to RGB format
         if im.mode not in ('L', 'RGB', 'RGBA'):
             im = im.convert('RGB')
+            decoded += get_memory_estimate(im.size, im.mode, convert=False)
         
-        # Process
+        for processor in processors:
+            processor.memory_usage = {'estimated': estimated, 'decoded': decoded}
+            processor.source_size = source_size
+            processor.source_metadata = metadata
+        end_stage(self, 'decode', start, im.size)
+        
+        start = start_stage()
         im = self._fix_orientation(im)
-        size = self.proc_opts['size']
+        end_stage(self, 'orientation', start, im.size)
+        return im
+    
+    def resize_image(self, im, source_size=None):
+        """Resizes the image according to the ``size``, ``upscale`` and
+        ``crop`` options.
+        
+        ``source_size`` is the size of the source image, if ``im`` is an
+        already resized copy of it (see ``can_derive_from()``). The crop box
+        and the final size are then worked out on the source image, so that
+        the result has the same geometry as the one resized from it.
+        
+        """
+        size = self.spec.size
         upscale = self.proc_opts['upscale']
         crop = self.proc_opts['crop']
         if size is not None:
-            new_size = get_width_height_from_string(size)
-            im = self._resize(im, new_size, upscale, crop)
-        
+            start = start_stage()
+            im = self._resize(im, size, upscale, crop, source_size)
+            end_stage(self, 'resize', start, im.size)
+        return im
+    
+    def filter_image(self, im):
+        """Applies the filters that have been enabled in the options."""
+        start = start_stage()
         sharpen = self.proc_opts['sharpen']
         if sharpen:
             im = self._sharpen(im)
@@ -172,19 +579,301 @@ class ImageProcessor:
         detail = self.proc_opts['detail']
         if detail:
             im = self._detail(im)
+        end_stage(self, 'filter', start, im.size)
+        return im
+    
+    def encode_image(self, im):
+        """Saves the image in the requested format and returns the data
+        as an ImageContent object.
+        
+        The encoder options are the ``save_options`` of the spec (see
+        ``get_save_options()``). The EXIF data and the ICC profile of the
+        source image are kept only if the ``strip_metadata`` option is False.
         
-        # Save image data
+        If the ``max_bytes`` option is set and the format has a quality
+        setting (JPEG, WebP, AVIF), the highest quality up to the configured
+        one that keeps the data within ``max_bytes`` is searched for, with at
+        most ``MAX_BYTES_ENCODES`` encodes (see ``_encode_to_size()``).
+        
+        """
+        start = start_stage()
         format = self.proc_opts['format']
-        buffer = StringIO()
-    
-        if format == 'JPEG':
-            im.save(buffer, format, quality=settings.THUMBNAILS_QUALITY)
+        options = self.spec.save_options
+        if not self.proc_opts['strip_metadata']:
+            metadata = getattr(self, 'source_metadata', None) or {}
+            options = dict(options, **get_metadata_options(metadata))
+        if format == 'JPEG' and im.mode == 'RGBA':
+            # JPEG does not support transparency
+            im = im.convert('RGB')
+        if self.spec.max_bytes is not None and format in DEFAULT_QUALITY:
+            buffer = self._encode_to_size(im, format, options, self.spec.max_bytes)
         else:
-            im.save(buffer, format)
+            buffer = self._encode(im, format, options)
+        
+        end_stage(self, 'encode', start, im.size)
+        return ImageContent(buffer, im.size, format)
+    
+    def _encode(self, im, format, options):
+        # Encode directly to the file that is passed to the storage
+        buffer = SpooledTemporaryFile(max_size=settings.THUMBNAILS_SPOOL_MAX_SIZE)
+        im.save(buffer, format, **options)
+        return buffer
+    
+    def _encode_to_size(self, im, format, options, max_bytes):
+        """Encodes the image with the highest quality that fits in
+        ``max_bytes`` and returns the file it has been encoded to.
         
-        data = buffer.getvalue()
+        The first encode uses the configured quality. The next qualities are
+        estimated by interpolating the logarithm of the data size between the
+        closest qualities that have been tried, which usually converges in
+        two or three encodes. If no quality fits, the smallest result is
+        returned.
         
-        return ContentFile(data)
+        """
+        quality = options.get('quality', DEFAULT_QUALITY[format])
+        low, high = self.MIN_QUALITY, quality
+        # (quality, size, buffer) of the highest quality that fits and of
+        # the lowest qualities that do not fit
+        fitting = None
+        too_big = []
+        for i in range(self.MAX_BYTES_ENCODES):
+            buffer = self._encode(im, format, dict(options, quality=quality))
+            buffer.seek(0, 2)
+            result = (quality, buffer.tell(), buffer)
+            if result[1] <= max_bytes:
+                if fitting is not None:
+                    fitting[2].close()
+                fitting = result
+                low = quality + 1
+            else:
+                for q, size, other in too_big[1:]:
+                    other.close()
+                too_big = [result] + too_big[:1]
+                high = quality - 1
+            if low > high:
+                break
+            
+            # Estimate the quality that produces max_bytes, assuming that the
+            # logarithm of the size is linear in the quality
+            q2, size2 = too_big[0][:2]
+            if fitting is not None:
+                q1, size1 = fitting[:2]
+            elif len(too_big) > 1:
+                q1, size1 = too_big[1][:2]
+            else:
+                q1, size1 = None, None
+            if q1 is None or size1 == size2:
+                quality = q2 * max_bytes // size2
+            else:
+                slope = (math.log(size2) - math.log(size1)) / (q2 - q1)
+                quality = q2 - (math.log(size2) - math.log(max_bytes)) / slope
+            quality = max(low, min(high, int(quality)))
+        if fitting is not None:
+            for q, size, other in too_big:
+                other.close()
+            return fitting[2]
+        for q, size, other in too_big[1:]:
+            other.close()
+        return too_big[0][2]
+    
+    def process_image(self, content=None, close=False):
+        """Processes and returns the image data.
+        
+        If the image data satisfies the options already, a copy of it is
+        returned instead (see ``pass_through()``).
+        
+        If ``close`` is True or the image data is read from the storage, the
+        data is closed as soon as it has been decoded or copied, so that it
+        is not kept open while the image is processed.
+        
+        """
+        close_content = close or content is None
+        if content is None:
+            content = self.get_image_content()
+        try:
+            passthrough = self.pass_through(content)
+            if passthrough is not None:
+                return passthrough
+            im = self.open_image(content)
+        finally:
+            if close_content:
+                content.close()
+        im = self.resize_image(im)
+        im = self.filter_image(im)
+        return self.encode_image(im)
+    
+    def may_pass_through(self):
+        """Returns whether the options allow the image data to be used as
+        it is, without looking at the data."""
+        opts = self.proc_opts
+        return bool(opts['passthrough'] and not (opts['sharpen'] or
+            opts['detail'] or opts['encoder_options']))
+    
+    def can_pass_through(self, info, data_size):
+        """Returns whether image data of ``data_size`` bytes, which
+        ``probe_image()`` described as ``info``, satisfies the options as it
+        is.
+        
+        This is the case if the data is in the requested format, it would
+        not be resized, cropped, rotated or converted to another mode, it fits
+        in ``max_bytes`` and it contains no metadata that would be stripped.
+        Images with metadata other than the EXIF data and the ICC profile,
+        such as XMP or IPTC data, are always processed.
+        
+        """
+        if not self.may_pass_through():
+            return False
+        if info.format != self.proc_opts['format'].upper():
+            return False
+        if info.mode not in ('L', 'RGB', 'RGBA') or info.orientation not in (None, 1):
+            return False
+        if info.metadata and self.proc_opts['strip_metadata']:
+            return False
+        if [key for key in info.metadata if key not in KEPT_METADATA_KEYS]:
+            # Processed images would not keep it either
+            return False
+        if self.spec.max_bytes is not None and data_size > self.spec.max_bytes:
+            return False
+        if self.spec.size is not None:
+            geometry = crop_resize(ImageGeometry(info.size), self.spec.size,
+                exact_size=self.proc_opts['upscale'], crop_mode=self.proc_opts['crop'])
+            if geometry.resized or geometry.box not in (None, (0, 0) + tuple(info.size)):
+                return False
+        return True
+    
+    def pass_through(self, content, info=None):
+        """Returns a copy of the image data ``content`` as an
+        ``ImageContent`` object if it satisfies the options as it is (see
+        ``can_pass_through()``), or None if it has to be processed.
+        
+        Only the header of the image is read to decide, unless ``info`` has
+        been probed already. The stage is reported as ``passthrough``.
+        
+        """
+        if not self.may_pass_through():
+            return None
+        start = start_stage()
+        if info is None:
+            try:
+                info = probe_image(content)
+            except IOError:
+                # Let open_image() report invalid image data
+                return None
+        if not self.can_pass_through(info, content.size):
+            return None
+        self.source_size = info.size
+        buffer = SpooledTemporaryFile(max_size=settings.THUMBNAILS_SPOOL_MAX_SIZE)
+        for chunk in content.chunks():
+            buffer.write(chunk)
+        collector.increment('thumbnail_works_passthrough_total', identifier=self.identifier)
+        end_stage(self, 'passthrough', start, info.size)
+        return ImageContent(buffer, info.size, info.format)
+    
+    def _get_budget_draft_size(self, im, processors):
+        """Returns the size to decode the JPEG image ``im`` at for all
+        ``processors`` or None to decode it at full size.
+        
+        If the size that keeps the quality of the results does not fit in
+        the limits, the smallest size that is still big enough is used.
+        
+        """
+        draft_size = get_draft_size(processors, im.size)
+        decoded_size = get_draft_result(im.size, draft_size)
+        if not self._exceeds_limits(decoded_size, get_memory_estimate(decoded_size, im.mode)):
+            return draft_size
+        min_size = get_draft_size(processors, im.size, oversampling=1)
+        if min_size is None:
+            return draft_size
+        return min_size
+    
+    def _exceeds_limits(self, size, memory):
+        max_pixels = settings.THUMBNAILS_MAX_PIXELS
+        budget = settings.THUMBNAILS_MEMORY_BUDGET
+        return bool((max_pixels and size[0] * size[1] > max_pixels) or
+            (budget and memory > budget))
+    
+    def _check_limits(self, size, memory):
+        if self._exceeds_limits(size, memory):
+            raise ImageTooLargeError('Decoding a %dx%d image needs %d bytes, '
+                'which exceeds the limits' % (size[0], size[1], memory))
+    
+    def get_draft_size(self, source_size, oversampling=None):
+        """Returns the minimum size the source image may be decoded at.
+        
+        ``source_size``
+            The size of the source image.
+        ``oversampling``
+            Defaults to ``THUMBNAILS_DRAFT_OVERSAMPLING``.
+        
+        The returned size keeps ``oversampling`` times the pixels needed by
+        the ``size`` option on each side, so that the quality of the final
+        image is not affected. ``None`` is returned if the source image needs
+        to be decoded at full size.
+        
+        """
+        size = self.spec.size
+        if oversampling is None:
+            oversampling = settings.THUMBNAILS_DRAFT_OVERSAMPLING
+        if size is None or not oversampling:
+            return None
+        width, height = size
+        source_width, source_height = source_size
+        # Cropping happens before resizing, so the largest ratio is required
+        ratio = max(float(width) / source_width, float(height) / source_height)
+        ratio *= oversampling
+        if ratio > 0.5:
+            # The decoder cannot scale by less than 1/2
+            return None
+        return (int(math.ceil(source_width * ratio)),
+            int(math.ceil(source_height * ratio)))
+    
+    def get_target_area(self):
+        """Returns the area of the ``size`` option or None if the image is
+        not resized."""
+        size = self.spec.size
+        if size is None:
+            return None
+        width, height = size
+        return width * height
+    
+    def can_derive_from(self, im, source_size):
+        """Checks whether this image can be resized from ``im`` instead of
+        the source image.
+        
+        ``im``
+            An already resized copy of the source image.
+        ``source_size``
+            The size of the source image.
+        
+        This is allowed only if ``im`` has kept the aspect ratio of the source
+        image and it is at least ``DERIVE_RATIO`` times bigger than the
+        requested ``size``, so that the result is as sharp as the one resized
+        from the source image. Its crop box and size are worked out on the
+        source image (see ``resize_image()``). ``im`` must also have
+        been resized with the default resampling (see
+        ``has_default_resampling()``), which the caller checks.
+        
+        """
+        size = self.spec.size
+        if size is None:
+            return False
+        width, height = size
+        source_width, source_height = source_size
+        im_width, im_height = im.size
+        # Rounding may cost a pixel on either side
+        if abs(im_width * source_height - im_height * source_width) > max(source_size):
+            return False
+        return im_width >= width * self.DERIVE_RATIO and \
+            im_height >= height * self.DERIVE_RATIO
+    
+    def has_default_resampling(self):
+        """Checks whether the image is resized with the default ``resample``
+        filter and ``speed`` profile, so that other images may be derived
+        from it. Faster filters and profiles lose details that the images
+        derived from it would lack too."""
+        proc_opts = self.spec.proc_opts
+        return proc_opts['resample'] == self.DEFAULT_OPTIONS['resample'] and \
+            proc_opts['speed'] == self.DEFAULT_OPTIONS['speed']
 
     # Processors
 
@@ -193,30 +882,45 @@ class ImageProcessor:
         Rotate (and/or flip) the thumbnail to respect the image EXIF orientation
         data.
         """
-        try:
-            exif = im._getexif()
-        except AttributeError:
-            exif = None
-        if exif:
-            orientation = exif.get(0x0112)
-            if orientation == 2:
-                im = im.transpose(im.FLIP_LEFT_RIGHT)
-            elif orientation == 3:
-                im = im.rotate(180)
-            elif orientation == 4:
-                im = im.transpose(im.FLIP_TOP_BOTTOM)
-            elif orientation == 5:
-                im = im.rotate(-90).transpose(im.FLIP_LEFT_RIGHT)
-            elif orientation == 6:
-                im = im.rotate(-90)
-            elif orientation == 7:
-                im = im.rotate(90).transpose(im.FLIP_LEFT_RIGHT)
-            elif orientation == 8:
-                im = im.rotate(90)
+        orientation = get_orientation(im)
+        if orientation == 2:
+            im = im.transpose(im.FLIP_LEFT_RIGHT)
+        elif orientation == 3:
+            im = im.rotate(180)
+        elif orientation == 4:
+            im = im.transpose(im.FLIP_TOP_BOTTOM)
+        elif orientation == 5:
+            im = im.rotate(-90).transpose(im.FLIP_LEFT_RIGHT)
+        elif orientation == 6:
+            im = im.rotate(-90)
+        elif orientation == 7:
+            im = im.rotate(90).transpose(im.FLIP_LEFT_RIGHT)
+        elif orientation == 8:
+            im = im.rotate(90)
         return im
     
-    def _resize(self, im, size, upscale, crop_mode):
-        return crop_resize(im, size, exact_size=upscale, crop_mode=crop_mode)
+    def _resize(self, im, size, upscale, crop_mode, source_size=None):
+        resample = self.proc_opts['resample']
+        speed = self.proc_opts['speed']
+        if source_size is not None and tuple(source_size) != im.size:
+            # Map the crop box of the source image onto the resized copy
+            geometry = crop_resize(ImageGeometry(source_size), size, exact_size=upscale, crop_mode=crop_mode)
+            left, top, right, bottom = geometry.box or (0, 0) + tuple(source_size)
+            x_scale = im.size[0] / float(source_size[0])
+            y_scale = im.size[1] / float(source_size[1])
+            box = (left * x_scale, top * y_scale, right * x_scale, bottom * y_scale)
+            return resize_image(im, geometry.size, RESAMPLE_FILTERS[resample], speed, box)
+        if resample == 'lanczos' and speed == 'quality':
+            return crop_resize(im, size, exact_size=upscale, crop_mode=crop_mode)
+        
+        # Let crop_resize() work out the crop box and the final size, so that
+        # the result has the same geometry in every crop mode
+        geometry = crop_resize(ImageGeometry(im.size), size, exact_size=upscale, crop_mode=crop_mode)
+        if geometry.box is not None:
+            im = im.crop(geometry.box)
+        if not geometry.resized:
+            return im
+        return resize_image(im, geometry.size, RESAMPLE_FILTERS[resample], speed)
     
     def _sharpen(self, im):
         return im.filter(ImageFilter.SHARPEN)
@@ -224,3 +928,242 @@ class ImageProcessor:
     def _detail(self, im):
         return im.filter(ImageFilter.DETAIL)
 
+
+
+ImageInfo = namedtuple('ImageInfo', 'format size mode orientation metadata')
+
+
+class ImageGeometry(object):
+    """Stands in for an image in ``crop_resize()`` and records the crop box
+    and the size that the image would be resized to."""
+    
+    def __init__(self, size, box=None, resized=False):
+        self.size = size
+        self.box = box
+        self.resized = resized
+    
+    def crop(self, box):
+        left, top, right, bottom = box
+        if self.box is not None:
+            left, top = left + self.box[0], top + self.box[1]
+            right, bottom = right + self.box[0], bottom + self.box[1]
+        return ImageGeometry((right - left, bottom - top), (left, top, right, bottom))
+    
+    def resize(self, size, resample=None):
+        return ImageGeometry(size, self.box, True)
+
+
+def resize_image(im, size, resample, speed='quality', box=None):
+    """Resizes ``im`` to ``size`` with the ``resample`` filter.
+    
+    Unless ``speed`` is ``quality``, large images are first reduced by an
+    integer factor (``balanced``) or with the nearest neighbour filter
+    (``fast``) to no less than two or three times ``size`` (see
+    ``SPEED_PROFILES``), so that the final filter works on fewer pixels.
+    
+    If ``box`` is set, only that region of ``im`` is resized. Its
+    coordinates may be fractions of pixels; they are rounded if the region
+    has to be cropped first.
+    
+    """
+    if box is not None:
+        if speed == 'quality':
+            try:
+                return im.resize(size, resample, box)
+            except TypeError:
+                # PIL before Pillow 4.3 cannot resize a region of an image
+                pass
+        im = im.crop(tuple([int(round(value)) for value in box]))
+    method, gap = SPEED_PROFILES[speed]
+    width, height = size
+    if method == 'reduce':
+        factor = int(min(im.size[0] // (width * gap), im.size[1] // (height * gap)))
+        if factor > 1:
+            if hasattr(im, 'reduce'):
+                try:
+                    im = im.reduce(factor)
+                except ValueError:
+                    # Bilevel, palette and 16-bit images cannot be reduced
+                    pass
+            else:
+                # Pillow before 7.0 has no reduce(); the box filter averages
+                # the same blocks of pixels
+                im = im.resize((im.size[0] // factor, im.size[1] // factor),
+                    RESAMPLE_FILTERS.get('box', Image.NEAREST))
+    elif method == 'nearest':
+        reduced_size = (width * gap, height * gap)
+        if reduced_size[0] < im.size[0] and reduced_size[1] < im.size[1]:
+            im = im.resize(reduced_size, Image.NEAREST)
+    return im.resize(size, resample)
+
+
+def probe_image(content):
+    """Returns an ``ImageInfo`` with the format, size, mode, EXIF
+    orientation and the names of the metadata (``METADATA_KEYS``) of the
+    image data ``content``.
+    
+    The markers of the JPEG APPn segments that PIL does not report as such
+    metadata, eg ``APP1`` for XMP data with older versions, are included in
+    the names as well (see ``get_app_segments()``).
+    
+    Only the image header is read. The pixels are not decoded.
+    
+    """
+    content.seek(0)
+    im = Image.open(content)
+    metadata = [key for key in METADATA_KEYS if im.info.get(key)]
+    metadata.extend(get_app_segments(im))
+    return ImageInfo(im.format, im.size, im.mode, get_orientation(im), tuple(metadata))
+
+
+def get_app_segments(im):
+    """Returns the markers of the APPn segments of the JPEG image ``im``
+    other than the JFIF header, the EXIF data and the ICC profile."""
+    markers = []
+    for marker, data in getattr(im, 'applist', ()):
+        plain = [prefix for plain_marker, prefix in PLAIN_APP_SEGMENTS
+            if marker == plain_marker and data.startswith(prefix)]
+        if not plain and marker not in markers:
+            markers.append(marker)
+    return markers
+
+
+def get_orientation(im):
+    """Returns the EXIF orientation of the image or None."""
+    try:
+        exif = im._getexif()
+    except AttributeError:
+        exif = None
+    if exif:
+        return exif.get(0x0112)
+
+
+def get_memory_estimate(size, mode, convert=True):
+    """Returns the bytes needed to hold the decoded pixels of an image.
+    
+    If ``convert`` is set, the memory of the copy converted to one of the
+    modes the processors support is included.
+    
+    """
+    pixels = size[0] * size[1]
+    # PIL keeps the pixels of multi-band modes in 4 bytes
+    memory = pixels * (mode in ('1', 'L', 'P') and 1 or 4)
+    if convert and mode not in ('L', 'RGB', 'RGBA'):
+        memory += pixels * 4
+    return memory
+
+
+def get_draft_size(processors, source_size, oversampling=None):
+    """Returns the minimum size the source image may be decoded at so that
+    it suits all ``processors``, or None for the full size."""
+    draft_size = (0, 0)
+    for processor in processors:
+        size = processor.get_draft_size(source_size, oversampling)
+        if size is None:
+            return None
+        draft_size = max(draft_size[0], size[0]), max(draft_size[1], size[1])
+    return draft_size
+
+
+def get_draft_result(source_size, draft_size):
+    """Returns the size a JPEG image of ``source_size`` is decoded at when
+    ``draft_size`` is requested, in the way ``Image.draft()`` selects it."""
+    if draft_size is None:
+        return source_size
+    scale = min(source_size[0] // max(draft_size[0], 1),
+        source_size[1] // max(draft_size[1], 1))
+    for factor in (8, 4, 2, 1):
+        if scale >= factor:
+            break
+    return ((source_size[0] + factor - 1) // factor,
+        (source_size[1] + factor - 1) // factor)
+
+
+def pass_through_images(processors, content, process, close=False):
+    """Returns a list of ImageContent objects in the order of ``processors``.
+    
+    The image data ``content`` is used as it is by the ``processors`` it
+    satisfies already (see ``ImageProcessor.pass_through()``). It is probed
+    only once. The other processors are passed to ``process(processors,
+    content, close)``, which returns their ImageContent objects.
+    
+    If ``close`` is True, ``content`` is closed as soon as it is not needed
+    any more.
+    
+    """
+    contents = [None] * len(processors)
+    candidates = [index for index, p in enumerate(processors) if p.may_pass_through()]
+    if candidates:
+        try:
+            info = probe_image(content)
+        except IOError:
+            # Let the processing report invalid image data
+            candidates = []
+        for index in candidates:
+            contents[index] = processors[index].pass_through(content, info)
+    pending = [index for index, c in enumerate(contents) if c is None]
+    if pending:
+        processed = process([processors[index] for index in pending], content, close)
+        for index, processed_content in zip(pending, processed):
+            contents[index] = processed_content
+    elif close:
+        content.close()
+    return contents
+
+
+def process_images(processors, content, close=False):
+    """Processes the same source image data using several image processors.
+    
+    ``processors``
+        A list of ``ImageProcessor`` instances, usually thumbnails.
+    ``content``
+        The image data of the source image.
+    ``close``
+        If True, ``content`` is closed as soon as it has been decoded, before
+        the images are resized and encoded.
+    
+    The source image data is decoded only once. The images are then resized
+    from the largest to the smallest one, so that each image is resized from
+    the smallest previously resized image it can be derived from (see
+    ``ImageProcessor.can_derive_from()``) instead of the full resolution
+    source image. Only images that are resized with the default resampling
+    are used this way. Filtering and encoding take place concurrently if
+    ``THUMBNAILS_WORKERS`` is set.
+    
+    Processors that the image data satisfies already get a copy of it
+    without decoding (see ``pass_through_images()``).
+    
+    Returns a list of ImageContent objects in the order of ``processors``.
+    
+    """
+    if not processors:
+        return []
+    return pass_through_images(processors, content, _process_images, close)
+
+
+def _process_images(processors, content, close=False):
+    source_im = processors[0].open_image(content, processors, close)
+    
+    def sort_key(index):
+        area = processors[index].get_target_area()
+        # Images that are not resized come first
+        return (area is not None, -(area or 0))
+    
+    bases = []
+    resized = [None] * len(processors)
+    for index in sorted(range(len(processors)), key=sort_key):
+        processor = processors[index]
+        im = source_im
+        for base in reversed(bases):
+            if processor.can_derive_from(base, source_im.size):
+                im = base
+                break
+        im = processor.resize_image(im, source_im.size)
+        if im is not source_im and processor.has_default_resampling():
+            bases.append(im)
+        resized[index] = im
+    
+    def encode(args):
+        processor, im = args
+        return processor.encode_image(processor.filter_image(im))
+    return run_tasks(encode, zip(processors, resized))
@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of django-thumbnail-works.
+#
+#  django-thumbnail-works adds thumbnail support to the default ImageField.
+#
+#  Development Web Site:
+#    - http://www.codetrax.org/projects/django-thumbnail-works
+#  Public Source Code Repository:
+#    - https://source.codetrax.org/hgroot/django-thumbnail-works
+#
+#  Copyright 2010 George Notaras <gnot [at] g-loaded.eu>
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""Locks that prevent concurrent generation of the same thumbnail.
+
+When several processes access a missing thumbnail at the same time, only the
+one that acquires the lock generates it. The others wait for it, up to
+``THUMBNAILS_LOCK_TIMEOUT`` seconds, and then use the generated thumbnail.
+
+A lock backend provides ``acquire(key, timeout)``, which returns a token or
+None if the lock could not be acquired in time, and ``release(token)``.
+
+"""
+
+import os
+import tempfile
+import threading
+import time
+import uuid
+from hashlib import md5
+
+from thumbnail_works import settings
+from thumbnail_works.utils import import_object
+
+
+# Seconds to sleep between attempts to acquire a lock
+POLL_INTERVAL = 0.05
+
+
+def get_lock_name(key):
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return 'thumbnail_works-%s.lock' % md5(key).hexdigest()
+
+
+class FileLock(object):
+    """Uses ``flock()`` on lock files in the ``THUMBNAILS_LOCK_DIR``
+    directory, the temporary directory by default.
+    
+    The lock is shared by the processes of the same host, or of all hosts
+    that have that directory on a shared filesystem that supports locking.
+    
+    The lock file is removed when the lock is released, so that lock files do
+    not accumulate. A process that locked a file that has been removed in the
+    meantime locks the new file instead.
+    
+    """
+    
+    def __init__(self):
+        self.directory = settings.THUMBNAILS_LOCK_DIR or tempfile.gettempdir()
+    
+    def acquire(self, key, timeout):
+        import fcntl
+        path = os.path.join(self.directory, get_lock_name(key))
+        deadline = time.time() + timeout
+        while True:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                os.close(fd)
+                if time.time() >= deadline:
+                    return None
+                time.sleep(POLL_INTERVAL)
+                continue
+            # Check that the holder of the lock did not remove the file
+            # between opening and locking it
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            fstat = os.fstat(fd)
+            if stat is not None and (stat.st_dev, stat.st_ino) == (fstat.st_dev, fstat.st_ino):
+                return fd, path
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+    
+    def release(self, token):
+        import fcntl
+        fd, path = token
+        # Remove the file while it is still locked
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+
+class CacheLock(object):
+    """Uses ``cache.add()`` on the Django cache ``THUMBNAILS_LOCK_CACHE``.
+    
+    The cache must be shared by all processes, eg memcached. A lock expires
+    after ``THUMBNAILS_LOCK_EXPIRE`` seconds, in case the process that holds
+    it dies.
+    
+    """
+    
+    def __init__(self):
+        from thumbnail_works.manifest import get_cache
+        self.cache = get_cache(settings.THUMBNAILS_LOCK_CACHE)
+    
+    def acquire(self, key, timeout):
+        key = get_lock_name(key)
+        value = uuid.uuid4().hex
+        deadline = time.time() + timeout
+        while not self.cache.add(key, value, settings.THUMBNAILS_LOCK_EXPIRE):
+            if time.time() >= deadline:
+                return None
+            time.sleep(POLL_INTERVAL)
+        return key, value
+    
+    def release(self, token):
+        key, value = token
+        # Do not remove a lock that has expired and been acquired again
+        if self.cache.get(key) == value:
+            self.cache.delete(key)
+
+
+_lock = None
+_lock_lock = threading.Lock()
+
+
+def get_lock():
+    """Returns the shared instance of the ``THUMBNAILS_LOCK_BACKEND``
+    class or None if the setting is not set."""
+    global _lock
+    path = settings.THUMBNAILS_LOCK_BACKEND
+    if path is None:
+        return None
+    if _lock is None:
+        with _lock_lock:
+            if _lock is None:
+                _lock = import_object(path)()
+    return _lock
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of django-thumbnail-works.
+#
+#  django-thumbnail-works adds thumbnail support to the default ImageField.
+#
+#  Development Web Site:
+#    - http://www.codetrax.org/projects/django-thumbnail-works
+#  Public Source Code Repository:
+#    - https://source.codetrax.org/hgroot/django-thumbnail-works
+#
+#  Copyright 2010 George Notaras <gnot [at] g-loaded.eu>
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import json
+import os
+import time
+from multiprocessing import Pool
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from thumbnail_works.fields import EnhancedImageField
+from thumbnail_works.utils import get_model, get_models, get_option_list
+
+
+def generate_thumbnails(task):
+    """Generates the missing thumbnails of one source image.
+    
+    Runs in the worker processes. Returns the number of generated
+    thumbnails and an error message or None.
+    
+    """
+    app_label, model_name, field_name, name, identifiers = task
+    try:
+        field = get_model(app_label, model_name)._meta.get_field(field_name)
+        source = field.attr_class(None, field, name)
+        return source.generate_missing_thumbnails(identifiers), None
+    except Exception as e:
+        return 0, '%s: %s: %s' % (name, e.__class__.__name__, e)
+
+
+class Command(BaseCommand):
+    help = 'Generates the missing thumbnails of all the EnhancedImageFields.'
+    
+    arguments = (
+        (('--app',), dict(dest='app', default=None,
+            help='Only process the models of this application.')),
+        (('--model',), dict(dest='model', default=None,
+            help='Only process this model.')),
+        (('--field',), dict(dest='field', default=None,
+            help='Only process this field.')),
+        (('--identifier',), dict(action='append', dest='identifiers', default=None,
+            help='Only generate this thumbnail. Can be used multiple times.')),
+        (('--chunk-size',), dict(type=int, dest='chunk_size', default=500,
+            help='Number of objects fetched from the database at a time.')),
+        (('--workers',), dict(type=int, dest='workers', default=1,
+            help='Number of worker processes.')),
+        (('--checkpoint',), dict(dest='checkpoint', default=None,
+            help='File that records the progress, so that an interrupted run '
+                'can be resumed. It is removed once the run completes.')),
+    )
+    
+    if hasattr(BaseCommand, 'option_list'):
+        # Django < 1.10
+        option_list = get_option_list(BaseCommand.option_list, arguments)
+    
+    def add_arguments(self, parser):
+        for args, kwargs in self.arguments:
+            parser.add_argument(*args, **kwargs)
+    
+    def handle(self, *args, **options):
+        fields = self.get_fields(options)
+        if not fields:
+            raise CommandError('No EnhancedImageField with thumbnails matches the filters.')
+        
+        self.checkpoint_path = options['checkpoint']
+        self.checkpoint = {}
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            f = open(self.checkpoint_path)
+            try:
+                self.checkpoint = json.load(f)
+            finally:
+                f.close()
+        
+        pool = None
+        if options['workers'] > 1:
+            # The workers do not use the database connection
+            connection.close()
+            pool = Pool(options['workers'])
+        
+        self.images = self.generated = self.errors = 0
+        start = time.time()
+        try:
+            for model, field, identifiers in fields:
+                self.process_field(model, field, identifiers, options['chunk_size'], pool)
+        finally:
+            if pool is not None:
+                pool.terminate()
+        elapsed = time.time() - start
+        
+        # The next run starts over, eg after the thumbnail options changed
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        
+        self.stdout.write('Processed %d images in %.1f seconds (%.1f images/sec)\n' % (
+            self.images, elapsed, self.images / max(elapsed, 0.001)))
+        self.stdout.write('Generated %d thumbnails, %d errors\n' % (self.generated, self.errors))
+    
+    def get_fields(self, options):
+        """Returns (model, field, identifiers) tuples for the fields that
+        match the filters."""
+        fields = []
+        for model in get_models():
+            opts = model._meta
+            if options['app'] and opts.app_label != options['app']:
+                continue
+            if options['model'] and options['model'].lower() not in (
+                    opts.object_name.lower(), '%s.%s' % (opts.app_label, opts.object_name.lower())):
+                continue
+            for field in opts.fields:
+                if not isinstance(field, EnhancedImageField) or not field.thumbnail_specs:
+                    continue
+                if options['field'] and field.name != options['field']:
+                    continue
+                identifiers = list(field.thumbnail_specs.keys())
+                if options['identifiers']:
+                    # Density variants are selected by the thumbnail identifier
+                    identifiers = [i for i in identifiers
+                        if dict(field.thumbnail_densities.get(i, [(1, i)]))[1] in options['identifiers']]
+                if identifiers:
+                    fields.append((model, field, identifiers))
+        return fields
+    
+    def process_field(self, model, field, identifiers, chunk_size, pool):
+        opts = model._meta
+        key = '%s.%s.%s' % (opts.app_label, opts.object_name, field.name)
+        queryset = model._default_manager.exclude(**{field.name: ''}).exclude(
+            **{'%s__isnull' % field.name: True}).order_by('pk')
+        last_pk = self.checkpoint.get(key)
+        while True:
+            chunk = queryset
+            if last_pk is not None:
+                chunk = chunk.filter(pk__gt=last_pk)
+            rows = list(chunk.values_list('pk', field.attname)[:chunk_size].iterator())
+            if not rows:
+                break
+            tasks = []
+            for pk, name in rows:
+                tasks.append((opts.app_label, opts.object_name, field.name, name, identifiers))
+            if pool is None:
+                results = map(generate_thumbnails, tasks)
+            else:
+                results = pool.imap_unordered(generate_thumbnails, tasks)
+            for generated, error in results:
+                self.images += 1
+                self.generated += generated
+                if error is not None:
+                    self.errors += 1
+                    self.stderr.write('%s\n' % error)
+            last_pk = rows[-1][0]
+            self.save_checkpoint(key, last_pk)
+            self.stdout.write('%s: %d images\n' % (key, self.images))
+    
+    def save_checkpoint(self, key, pk):
+        if not self.checkpoint_path:
+            return
+        self.checkpoint[key] = pk
+        temp_path = '%s.tmp' % self.checkpoint_path
+        f = open(temp_path, 'w')
+        try:
+            json.dump(self.checkpoint, f)
+        finally:
+            f.close()
+        os.rename(temp_path, self.checkpoint_path)
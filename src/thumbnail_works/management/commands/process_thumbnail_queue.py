@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of django-thumbnail-works.
+#
+#  django-thumbnail-works adds thumbnail support to the default ImageField.
+#
+#  Development Web Site:
+#    - http://www.codetrax.org/projects/django-thumbnail-works
+#  Public Source Code Repository:
+#    - https://source.codetrax.org/hgroot/django-thumbnail-works
+#
+#  Copyright 2010 George Notaras <gnot [at] g-loaded.eu>
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from thumbnail_works.queues import DatabaseQueue
+from thumbnail_works.utils import get_option_list
+
+
+class Command(BaseCommand):
+    help = 'Generates the thumbnails waiting in the database generation queue.'
+    
+    arguments = (
+        (('--limit',), dict(type=int, dest='limit', default=None,
+            help='Maximum number of thumbnails to generate in each run.')),
+        (('--loop',), dict(action='store_true', dest='loop', default=False,
+            help='Keep processing the queue until interrupted.')),
+        (('--sleep',), dict(type=float, dest='sleep', default=5,
+            help='Seconds to wait when the queue is empty in loop mode.')),
+    )
+    
+    if hasattr(BaseCommand, 'option_list'):
+        # Django < 1.10
+        option_list = get_option_list(BaseCommand.option_list, arguments)
+    
+    def add_arguments(self, parser):
+        for args, kwargs in self.arguments:
+            parser.add_argument(*args, **kwargs)
+    
+    def handle(self, *args, **options):
+        queue = DatabaseQueue()
+        while True:
+            processed, failed = queue.process(options['limit'])
+            if processed:
+                self.stdout.write('Processed %d thumbnails (%d failed)\n' % (processed, failed))
+            if not options['loop']:
+                break
+            if processed == failed:
+                # The queue is empty or the jobs are waiting to be retried
+                time.sleep(options['sleep'])
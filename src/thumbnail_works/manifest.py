@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of django-thumbnail-works.
+#
+#  django-thumbnail-works adds thumbnail support to the default ImageField.
+#
+#  Development Web Site:
+#    - http://www.codetrax.org/projects/django-thumbnail-works
+#  Public Source Code Repository:
+#    - https://source.codetrax.org/hgroot/django-thumbnail-works
+#
+#  Copyright 2010 George Notaras <gnot [at] g-loaded.eu>
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""The thumbnail manifest.
+
+The manifest records the thumbnails that have been generated, so that
+accessing a thumbnail does not require checking its existence on the storage.
+Entries are kept in an in-process LRU and, optionally, in the cache set by
+the ``THUMBNAILS_MANIFEST_CACHE`` setting, so that they are shared between
+processes.
+
+Entries are trusted without checking the storage. A process removes the
+entries of the thumbnails it deletes and of the images it saves, but the
+in-process entries of other processes are only updated through the cache.
+Without ``THUMBNAILS_MANIFEST_CACHE``, other processes may keep returning
+thumbnails of a deleted or replaced image until their entries are evicted.
+
+"""
+
+import threading
+from hashlib import md5
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+from thumbnail_works import settings
+
+
+def get_cache(alias):
+    """Returns the Django cache for ``alias``."""
+    try:
+        from django.core.cache import caches
+    except ImportError:
+        from django.core.cache import get_cache
+        return get_cache(alias)
+    return caches[alias]
+
+
+class ThumbnailManifest(object):
+    """Records which thumbnails exist on the storage.
+    
+    Entries are keyed by the name of the source image, the thumbnail
+    identifier and the digest of the ``ImageSpec`` of the thumbnail. Each entry
+    is a dictionary, which contains at least the ``name`` of the thumbnail on
+    the storage.
+    
+    """
+    
+    def __init__(self, max_entries=None, cache_alias=None):
+        if max_entries is None:
+            max_entries = settings.THUMBNAILS_MANIFEST_SIZE
+        if cache_alias is None:
+            cache_alias = settings.THUMBNAILS_MANIFEST_CACHE
+        self.max_entries = max_entries
+        self.cache_alias = cache_alias
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+    
+    @property
+    def cache(self):
+        if self.cache_alias is None:
+            return None
+        return get_cache(self.cache_alias)
+    
+    @property
+    def shared(self):
+        """Whether the entries are shared with other processes."""
+        return self.cache_alias is not None
+    
+    def get_key(self, source_name, identifier, spec):
+        key = '%s\0%s\0%s' % (source_name, identifier, spec.digest)
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return 'thumbnail_works:manifest:%s' % md5(key).hexdigest()
+    
+    def get(self, source_name, identifier, spec):
+        """Returns the entry of the thumbnail or None if it is not known."""
+        key = self.get_key(source_name, identifier, spec)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+                return entry
+        cache = self.cache
+        if cache is not None:
+            entry = cache.get(key)
+            if entry is not None:
+                self._remember(key, entry)
+        return entry
+    
+    def set(self, source_name, identifier, spec, entry):
+        """Records the entry of a thumbnail."""
+        key = self.get_key(source_name, identifier, spec)
+        self._remember(key, entry)
+        cache = self.cache
+        if cache is not None:
+            cache.set(key, entry)
+    
+    def delete(self, source_name, identifier, spec):
+        """Removes the entry of a thumbnail."""
+        key = self.get_key(source_name, identifier, spec)
+        with self._lock:
+            self._entries.pop(key, None)
+        cache = self.cache
+        if cache is not None:
+            cache.delete(key)
+    
+    def clear(self):
+        """Clears the in-process entries."""
+        with self._lock:
+            self._entries.clear()
+    
+    def _remember(self, key, entry):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+manifest = ThumbnailManifest()
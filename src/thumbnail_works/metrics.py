@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of django-thumbnail-works.
+#
+#  django-thumbnail-works adds thumbnail support to the default ImageField.
+#
+#  Development Web Site:
+#    - http://www.codetrax.org/projects/django-thumbnail-works
+#  Public Source Code Repository:
+#    - https://source.codetrax.org/hgroot/django-thumbnail-works
+#
+#  Copyright 2010 George Notaras <gnot [at] g-loaded.eu>
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import threading
+
+from thumbnail_works import settings
+
+
+# The metrics that are collected: name -> (type, help)
+METRICS = {
+    'thumbnail_works_thumbnails_generated_total': ('counter',
+        'Thumbnails that have been generated and saved to the storage.'),
+    'thumbnail_works_thumbnail_lookups_total': ('counter',
+        'Lookups of thumbnails by result (manifest, storage or missing).'),
+    'thumbnail_works_storage_exists_total': ('counter',
+        'Calls of storage.exists() to check whether a thumbnail exists.'),
+    'thumbnail_works_storage_listdir_total': ('counter',
+        'Calls of storage.listdir() to find the thumbnails of many images.'),
+    'thumbnail_works_passthrough_total': ('counter',
+        'Images whose source data has been used as it is, without processing.'),
+    'thumbnail_works_no_access_to_image_total': ('counter',
+        'Source images that could not be read from the storage.'),
+    'thumbnail_works_generation_seconds': ('histogram',
+        'Seconds from the start of processing until a thumbnail is saved.'),
+    }
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(labels, **extra):
+    labels = list(labels) + sorted(extra.items())
+    if not labels:
+        return ''
+    def escape(value):
+        value = '%s' % value
+        return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{%s}' % ','.join(['%s="%s"' % (name, escape(value)) for name, value in labels])
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(value)
+
+
+class MetricsCollector(object):
+    """Keeps counters and histograms of the thumbnails in this process.
+    
+    The values accumulate from the start of the process and are rendered in
+    the Prometheus text format by ``render()``. Nothing is recorded if
+    ``THUMBNAILS_METRICS`` is False.
+    
+    """
+    
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        """Sets all the metrics back to zero."""
+        with self._lock:
+            self._counters = {}
+            self._histograms = {}
+    
+    def increment(self, name, amount=1, **labels):
+        """Adds ``amount`` to the counter ``name`` with ``labels``."""
+        if not settings.THUMBNAILS_METRICS:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+    
+    def observe(self, name, value, **labels):
+        """Records ``value`` in the histogram ``name`` with ``labels``."""
+        if not settings.THUMBNAILS_METRICS:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # Bucket counts, followed by the sum of the values
+                histogram = self._histograms[key] = [0] * len(self.buckets) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-1] += value
+    
+    def get_value(self, name, **labels):
+        """Returns the value of a counter, or the number of values recorded
+        in a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key in self._histograms:
+                return self._histograms[key][-2]
+            return self._counters.get(key, 0)
+    
+    def render(self):
+        """Returns all the metrics in the Prometheus text format."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict((key, list(value)) for key, value in self._histograms.items())
+        lines = []
+        for name in sorted(METRICS):
+            type, help = METRICS[name]
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, type))
+            if type == 'counter':
+                for key in sorted(counters):
+                    if key[0] == name:
+                        lines.append('%s%s %s' % (name, format_labels(key[1]), counters[key]))
+            else:
+                for key in sorted(histograms):
+                    if key[0] != name:
+                        continue
+                    histogram = histograms[key]
+                    for bound, count in zip(self.buckets, histogram):
+                        lines.append('%s_bucket%s %s' % (name,
+                            format_labels(key[1], le=format_value(bound)), count))
+                    lines.append('%s_sum%s %s' % (name, format_labels(key[1]),
+                        format_value(histogram[-1])))
+                    lines.append('%s_count%s %s' % (name, format_labels(key[1]),
+                        histogram[-2]))
+        return '\n'.join(lines) + '\n'
+
+
+collector = MetricsCollector()
+
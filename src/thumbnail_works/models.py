@@ -24,3 +24,28 @@
 #  limitations under the License.
 #
 
+from django.db import models
+
+
+class ThumbnailJob(models.Model):
+    """A thumbnail waiting to be generated by the ``DatabaseQueue``."""
+    app_label = models.CharField(max_length=100)
+    model_name = models.CharField(max_length=100)
+    field_name = models.CharField(max_length=100)
+    name = models.CharField(max_length=255)
+    identifier = models.CharField(max_length=100)
+    # The number of times the generation has failed
+    attempts = models.PositiveIntegerField(default=0)
+    # When a failed job may be tried again
+    next_attempt = models.DateTimeField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        ordering = ('pk',)
+        unique_together = (('app_label', 'model_name', 'field_name', 'name', 'identifier'),)
+    
+    def __unicode__(self):
+        return u'%s.%s' % (self.name, self.identifier)
+    
+    def get_job(self):
+        return (self.app_label, self.model_name, self.field_name, self.name, self.identifier)
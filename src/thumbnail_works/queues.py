@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of django-thumbnail-works.
+#
+#  django-thumbnail-works adds thumbnail support to the default ImageField.
+#
+#  Development Web Site:
+#    - http://www.codetrax.org/projects/django-thumbnail-works
+#  Public Source Code Repository:
+#    - https://source.codetrax.org/hgroot/django-thumbnail-works
+#
+#  Copyright 2010 George Notaras <gnot [at] g-loaded.eu>
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""Queues for generating delayed thumbnails in the background.
+
+If the ``THUMBNAILS_GENERATION_QUEUE`` setting is set, a thumbnail that is
+accessed for the first time is not generated within the request. It is put
+on the queue instead and a ``PendingThumbnail`` is returned until a worker
+generates it.
+
+A job is a tuple of ``(app_label, model_name, field_name, name, identifier)``
+where ``name`` is the name of the source image.
+
+"""
+
+import datetime
+import logging
+import threading
+
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from django.db.models import Q
+from django.utils.encoding import smart_str
+try:
+    from django.utils.timezone import now
+except ImportError:
+    # Django < 1.4
+    now = datetime.datetime.now
+
+from thumbnail_works import settings
+from thumbnail_works.utils import get_model, import_object
+
+
+logger = logging.getLogger('thumbnail_works')
+
+
+def get_job(source, identifier):
+    """Returns the job that generates the thumbnail ``identifier`` of the
+    ``source`` EnhancedImageFieldFile."""
+    opts = source.field.model._meta
+    return (opts.app_label, opts.object_name, source.field.name, source.name, identifier)
+
+
+def run_job(app_label, model_name, field_name, name, identifier):
+    """Generates a thumbnail, unless it already exists."""
+    field = get_model(app_label, model_name)._meta.get_field(field_name)
+    source = field.attr_class(None, field, name)
+    # Identifiers read from the database are unicode strings
+    source.get_thumbnail(smart_str(identifier))
+
+
+class BaseGenerationQueue(object):
+    """Base class of the thumbnail generation queues."""
+    
+    def enqueue(self, source, identifier):
+        """Puts the generation of the thumbnail ``identifier`` of the
+        ``source`` EnhancedImageFieldFile on the queue."""
+        raise NotImplementedError
+    
+    def run(self, job):
+        """Runs a job. Errors are logged, since the thumbnail is put on the
+        queue again the next time it is accessed."""
+        try:
+            run_job(*job)
+        except Exception:
+            logger.exception('Failed to generate thumbnail %s.%s', job[3], job[4])
+            return False
+        return True
+
+
+class ThreadQueue(BaseGenerationQueue):
+    """An in-process queue, which is processed by a daemon thread."""
+    
+    def __init__(self):
+        self._queue = Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = None
+    
+    def enqueue(self, source, identifier):
+        job = get_job(source, identifier)
+        with self._lock:
+            if job in self._pending:
+                return
+            self._pending.add(job)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, name='thumbnail_works')
+                self._thread.daemon = True
+                self._thread.start()
+        self._queue.put(job)
+    
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self.run(job)
+            finally:
+                with self._lock:
+                    self._pending.discard(job)
+                self._queue.task_done()
+    
+    def join(self):
+        """Blocks until all the queued thumbnails have been processed."""
+        self._queue.join()
+
+
+class DatabaseQueue(BaseGenerationQueue):
+    """A queue stored in the ``ThumbnailJob`` table.
+    
+    The queue is processed by the ``process_thumbnail_queue`` management
+    command. Jobs that fail are kept and tried again, up to ``MAX_ATTEMPTS``
+    times, after ``RETRY_DELAY`` seconds, doubled after each attempt. After
+    that, they are kept in the table, so that the errors can be looked into,
+    and deleting them lets the thumbnails be queued again.
+    
+    """
+    
+    MAX_ATTEMPTS = 3
+    RETRY_DELAY = 60
+    
+    def enqueue(self, source, identifier):
+        from thumbnail_works.models import ThumbnailJob
+        app_label, model_name, field_name, name, identifier = get_job(source, identifier)
+        # The unique constraint prevents duplicate jobs from concurrent requests
+        ThumbnailJob.objects.get_or_create(app_label=app_label, model_name=model_name,
+            field_name=field_name, name=name, identifier=identifier)
+    
+    def process(self, limit=None):
+        """Processes the queued jobs in the order they were queued.
+        Successful jobs are removed and failed ones are kept with their
+        number of attempts and the time they may be tried again. Returns the
+        number of processed and failed jobs."""
+        from thumbnail_works.models import ThumbnailJob
+        jobs = ThumbnailJob.objects.filter(Q(next_attempt__isnull=True) | Q(next_attempt__lte=now()),
+            attempts__lt=self.MAX_ATTEMPTS)
+        if limit:
+            jobs = jobs[:limit]
+        processed = failed = 0
+        for job in jobs:
+            processed += 1
+            if self.run(job.get_job()):
+                job.delete()
+            else:
+                failed += 1
+                delay = self.RETRY_DELAY * 2 ** job.attempts
+                job.attempts += 1
+                job.next_attempt = now() + datetime.timedelta(seconds=delay)
+                job.save()
+        return processed, failed
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_generation_queue():
+    """Returns the shared instance of the ``THUMBNAILS_GENERATION_QUEUE``
+    class or None if the setting is not set."""
+    global _queue
+    path = settings.THUMBNAILS_GENERATION_QUEUE
+    if path is None:
+        return None
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                _queue = import_object(path)()
+    return _queue
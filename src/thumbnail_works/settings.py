@@ -33,9 +33,76 @@ THUMBNAILS_FORMAT = getattr(settings, 'THUMBNAILS_FORMAT', 'JPEG')
 # For JPEG format only
 THUMBNAILS_QUALITY = getattr(settings, 'THUMBNAILS_QUALITY', 85)
 
+# Default encoder options per image format, eg {'JPEG': {'optimize': True}}
+THUMBNAILS_ENCODER_OPTIONS = getattr(settings, 'THUMBNAILS_ENCODER_OPTIONS', {})
+
 # This is the name of the directory where the thumbnails will be stored
 THUMBNAILS_DIRNAME = getattr(settings, 'THUMBNAILS_DIRNAME', 'thumbs')
 
 # Generate the thumbnails on first access rather than at the time the
 # original image is saved. 
 THUMBNAILS_DELAYED_GENERATION = getattr(settings, 'THUMBNAILS_DELAYED_GENERATION', True)
+
+# JPEG sources are decoded at a reduced scale (1/2, 1/4 or 1/8) that still
+# keeps this many times the pixels required by the requested size on each
+# side. Set to 0 to always decode JPEG sources at full size.
+THUMBNAILS_DRAFT_OVERSAMPLING = getattr(settings, 'THUMBNAILS_DRAFT_OVERSAMPLING', 2)
+
+# The number of threads used to generate and delete the thumbnails of an
+# image concurrently. Set to 1 to process thumbnails one after another.
+THUMBNAILS_WORKERS = getattr(settings, 'THUMBNAILS_WORKERS', 1)
+
+# The dotted path to the class that processes the images. Can be overridden
+# per field by the ``processing_backend`` argument of EnhancedImageField.
+THUMBNAILS_PROCESSING_BACKEND = getattr(settings, 'THUMBNAILS_PROCESSING_BACKEND', 'thumbnail_works.backends.InProcessBackend')
+
+# The maximum number of thumbnails the in-process manifest keeps track of.
+# The manifest saves checking whether thumbnails exist on the storage.
+THUMBNAILS_MANIFEST_SIZE = getattr(settings, 'THUMBNAILS_MANIFEST_SIZE', 10000)
+
+# The alias of a Django cache that shares the manifest between processes.
+THUMBNAILS_MANIFEST_CACHE = getattr(settings, 'THUMBNAILS_MANIFEST_CACHE', None)
+
+# The dotted path to the queue class that generates delayed thumbnails in the
+# background, eg 'thumbnail_works.queues.ThreadQueue'. If not set, delayed
+# thumbnails are generated within the request that accesses them.
+THUMBNAILS_GENERATION_QUEUE = getattr(settings, 'THUMBNAILS_GENERATION_QUEUE', None)
+
+# The URL of thumbnails that are waiting in the generation queue. If not set,
+# the URL of the source image is used.
+THUMBNAILS_PLACEHOLDER_URL = getattr(settings, 'THUMBNAILS_PLACEHOLDER_URL', None)
+
+# The dotted path to the lock class that prevents concurrent generation of
+# the same thumbnail, eg 'thumbnail_works.locks.FileLock' or
+# 'thumbnail_works.locks.CacheLock'. If not set, no locking takes place.
+THUMBNAILS_LOCK_BACKEND = getattr(settings, 'THUMBNAILS_LOCK_BACKEND', None)
+
+# Seconds to wait for a thumbnail that another process is generating.
+THUMBNAILS_LOCK_TIMEOUT = getattr(settings, 'THUMBNAILS_LOCK_TIMEOUT', 10)
+
+# The directory of the lock files of FileLock. Defaults to the temporary directory.
+THUMBNAILS_LOCK_DIR = getattr(settings, 'THUMBNAILS_LOCK_DIR', None)
+
+# The alias of the Django cache used by CacheLock.
+THUMBNAILS_LOCK_CACHE = getattr(settings, 'THUMBNAILS_LOCK_CACHE', 'default')
+
+# Seconds after which a lock of CacheLock expires.
+THUMBNAILS_LOCK_EXPIRE = getattr(settings, 'THUMBNAILS_LOCK_EXPIRE', 60)
+
+# Source images read from storages other than the local filesystem are kept
+# in memory up to this size in bytes. Larger images are spooled to disk.
+THUMBNAILS_SPOOL_MAX_SIZE = getattr(settings, 'THUMBNAILS_SPOOL_MAX_SIZE', 2621440)
+
+# Images with more pixels than this are not decoded at full size. JPEG images
+# are decoded at a reduced scale if possible, other images are rejected.
+THUMBNAILS_MAX_PIXELS = getattr(settings, 'THUMBNAILS_MAX_PIXELS', None)
+
+# The maximum memory in bytes the decoded pixels of an image may need.
+THUMBNAILS_MEMORY_BUDGET = getattr(settings, 'THUMBNAILS_MEMORY_BUDGET', None)
+
+# Collect metrics of the generated and found thumbnails in each process.
+THUMBNAILS_METRICS = getattr(settings, 'THUMBNAILS_METRICS', True)
+
+# Name source images after their content, so that identical uploads share
+# the stored image and its thumbnails. Can be overridden per field.
+THUMBNAILS_CONTENT_ADDRESSED = getattr(settings, 'THUMBNAILS_CONTENT_ADDRESSED', False)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of django-thumbnail-works.
+#
+#  django-thumbnail-works adds thumbnail support to the default ImageField.
+#
+#  Development Web Site:
+#    - http://www.codetrax.org/projects/django-thumbnail-works
+#  Public Source Code Repository:
+#    - https://source.codetrax.org/hgroot/django-thumbnail-works
+#
+#  Copyright 2010 George Notaras <gnot [at] g-loaded.eu>
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+import time
+
+from django.dispatch import Signal
+
+
+# Sent after each stage of reading, processing and saving an image.
+#
+# Arguments: ``processor`` (the ImageProcessor, usually an
+# EnhancedImageFieldFile or a ThumbnailFieldFile), ``stage`` (one of 'read',
+# 'decode', 'orientation', 'resize', 'filter', 'encode' and 'save'),
+# ``field``, ``identifier``, ``source_size``, ``output_size`` and
+# ``elapsed`` (seconds).
+stage_timed = Signal()
+
+
+def start_stage():
+    """Returns the time a stage starts, or None if there are no receivers
+    of ``stage_timed``, so that stages are not timed in vain."""
+    if stage_timed.receivers:
+        return time.time()
+    return None
+
+
+def end_stage(processor, stage, start, output_size=None):
+    """Sends ``stage_timed`` for a stage that has been started with
+    ``start_stage()``."""
+    if start is None:
+        return
+    elapsed = time.time() - start
+    stage_timed.send(sender=processor.__class__, processor=processor,
+        stage=stage, field=getattr(processor, 'field', None),
+        identifier=getattr(processor, 'identifier', None),
+        source_size=getattr(processor, 'source_size', None),
+        output_size=output_size, elapsed=elapsed)
+
@@ -31,8 +31,164 @@ unittest). These will both pass when you run "manage.py test".
 Replace these with more appropriate tests for your application.
 """
 
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+
+from django.core.files.base import ContentFile, File
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.db import connection, models
 from django.test import TestCase
 
+from thumbnail_works import locks, queues, settings
+from thumbnail_works.backends import InProcessBackend, ProcessPoolBackend
+from thumbnail_works.bulk import delete_images, prefetch_thumbnails
+from thumbnail_works.exceptions import ImageTooLargeError, NoAccessToImage, ThumbnailOptionError
+from thumbnail_works.fields import EnhancedImageField
+from thumbnail_works.images import ImageProcessor, ImageSpec, process_images
+from thumbnail_works.manifest import ThumbnailManifest, manifest
+from thumbnail_works.locks import FileLock
+from thumbnail_works.metrics import MetricsCollector, collector
+from thumbnail_works.models import ThumbnailJob
+from thumbnail_works.queues import DatabaseQueue
+from thumbnail_works.signals import stage_timed
+from thumbnail_works.utils import get_bytes_from_string
+from thumbnail_works.workers import run_tasks
+
+
+def get_processor(**proc_opts):
+    processor = ImageProcessor()
+    processor.identifier = 'test'
+    processor.setup_image_processing_options(proc_opts)
+    return processor
+
+
+def get_image_data(size=(800, 600), format='JPEG'):
+    """Returns the data of an image with some detail to resize."""
+    im = Image.new('RGB', size)
+    im.putdata([(x % 256, y % 256, (x * y) % 256)
+        for y in range(size[1]) for x in range(size[0])])
+    buffer = StringIO()
+    im.save(buffer, format)
+    return buffer.getvalue()
+
+
+def get_image_size(storage, name):
+    f = storage.open(name)
+    try:
+        return Image.open(f).size
+    finally:
+        f.close()
+
+
+def create_table(model):
+    """Creates the table of a model that is only used by the tests."""
+    if model._meta.db_table in connection.introspection.table_names():
+        return
+    if hasattr(connection, 'schema_editor'):
+        with connection.schema_editor() as editor:
+            editor.create_model(model)
+    else:
+        from django.core.management.color import no_style
+        cursor = connection.cursor()
+        for sql in connection.creation.sql_create_model(model, no_style())[0]:
+            cursor.execute(sql)
+
+
+storage = FileSystemStorage(location=tempfile.mkdtemp(prefix='thumbnail_works-'),
+    base_url='/media/')
+
+
+class Photo(models.Model):
+    image = EnhancedImageField(upload_to='photos', storage=storage, blank=True,
+        thumbnails={
+            'avatar': dict(size='80x60'),
+            'square': dict(size='100x100', crop=True),
+            'medium': dict(size='320x240', sharpen=True),
+            'wide': dict(size='400x100', format='PNG'),
+        })
+    
+    class Meta:
+        app_label = 'thumbnail_works'
+
+
+class SharedPhoto(models.Model):
+    image = EnhancedImageField(upload_to='photos', storage=storage, blank=True,
+        content_addressed=True, thumbnails={
+            'avatar': dict(size='80x60'),
+            'wide': dict(size='400x100', format='PNG'),
+        })
+    
+    class Meta:
+        app_label = 'thumbnail_works'
+
+
+class RetinaPhoto(models.Model):
+    image = EnhancedImageField(upload_to='photos', storage=storage, blank=True,
+        thumbnails={
+            'avatar': dict(size='80x60', densities=(1, 2, 1.5)),
+        })
+    
+    class Meta:
+        app_label = 'thumbnail_works'
+
+
+class FieldTestCase(TestCase):
+    """Saves images of ``Photo`` objects on a FileSystemStorage in a
+    temporary directory, which is emptied after each test."""
+    
+    @classmethod
+    def setUpClass(cls):
+        # Tables cannot be created in the transaction of the test case
+        create_table(Photo)
+        create_table(SharedPhoto)
+        create_table(RetinaPhoto)
+        super(FieldTestCase, cls).setUpClass()
+    
+    def setUp(self):
+        self.old_settings = {}
+        manifest.clear()
+        self.devnull = open(os.devnull, 'w')
+    
+    def tearDown(self):
+        self.devnull.close()
+        for name, value in self.old_settings.items():
+            setattr(settings, name, value)
+        manifest.clear()
+        shutil.rmtree(storage.location)
+        os.makedirs(storage.location)
+    
+    def set_setting(self, name, value):
+        self.old_settings.setdefault(name, getattr(settings, name))
+        setattr(settings, name, value)
+    
+    def create_photo(self, name='photo.jpg', data=None, field_name='image', model=Photo):
+        photo = model()
+        if data is None:
+            data = get_image_data()
+        getattr(photo, field_name).save(name, ContentFile(data))
+        return photo
+    
+    def list_thumbnails(self):
+        dirname = os.path.join('photos', settings.THUMBNAILS_DIRNAME)
+        if not storage.exists(dirname):
+            return []
+        return sorted(storage.listdir(dirname)[1])
+
+
 class SimpleTest(TestCase):
     def test_basic_addition(self):
         """
@@ -40,6 +196,870 @@ class SimpleTest(TestCase):
         """
         self.failUnlessEqual(1 + 1, 2)
 
+class DraftSizeTest(TestCase):
+    
+    def setUp(self):
+        self.oversampling = settings.THUMBNAILS_DRAFT_OVERSAMPLING
+        settings.THUMBNAILS_DRAFT_OVERSAMPLING = 2
+    
+    def tearDown(self):
+        settings.THUMBNAILS_DRAFT_OVERSAMPLING = self.oversampling
+    
+    def test_small_thumbnail(self):
+        processor = get_processor(size='80x60')
+        self.assertEqual(processor.get_draft_size((4000, 3000)), (160, 120))
+    
+    def test_crop_uses_largest_ratio(self):
+        processor = get_processor(size='400x100')
+        self.assertEqual(processor.get_draft_size((4000, 3000)), (800, 600))
+    
+    def test_full_size_decoding(self):
+        self.assertEqual(get_processor().get_draft_size((4000, 3000)), None)
+        processor = get_processor(size='1600x1200')
+        self.assertEqual(processor.get_draft_size((4000, 3000)), None)
+        settings.THUMBNAILS_DRAFT_OVERSAMPLING = 0
+        processor = get_processor(size='80x60')
+        self.assertEqual(processor.get_draft_size((4000, 3000)), None)
+
+class ImageSpecTest(TestCase):
+    
+    def test_compiled_options(self):
+        spec = ImageSpec('my avatar', dict(size='80x60', format='PNG'))
+        self.assertEqual(spec.identifier, 'my_avatar')
+        self.assertEqual(spec.size, (80, 60))
+        self.assertEqual(spec.proc_opts['sharpen'], False)
+        processor = ImageProcessor()
+        processor.identifier = spec.identifier
+        processor.setup_image_processing_options(spec)
+        self.assertTrue(processor.spec is spec)
+        self.assertEqual(processor.generate_image_name('images/photo.jpg'),
+            'images/%s/photo.my_avatar.png' % settings.THUMBNAILS_DIRNAME)
+    
+    def test_immutable(self):
+        spec = ImageSpec(None, {})
+        self.assertRaises(AttributeError, setattr, spec, 'size', (10, 10))
+        encoder_options = {'optimize': True}
+        spec = ImageSpec('avatar', dict(size='80x60', encoder_options=encoder_options))
+        encoder_options['progressive'] = True
+        self.assertEqual(spec.proc_opts['encoder_options'], {'optimize': True})
+        self.assertRaises(TypeError, spec.proc_opts.__setitem__, 'size', '10x10')
+        self.assertRaises(TypeError, spec.proc_opts.update, size='10x10')
+        self.assertRaises(TypeError, spec.proc_opts['encoder_options'].pop, 'optimize')
+        self.assertRaises(TypeError, spec.save_options.clear)
+        processor = ImageProcessor()
+        processor.identifier = 'avatar'
+        processor.setup_image_processing_options(spec)
+        processor.proc_opts['sharpen'] = True
+        self.assertEqual(spec.proc_opts['sharpen'], False)
+        self.assertEqual(pickle.loads(pickle.dumps(spec)).proc_opts, spec.proc_opts)
+    
+    def test_digest(self):
+        digest = ImageSpec('avatar', dict(size='80x60', format='JPEG')).digest
+        self.assertEqual(ImageSpec('avatar', {'format': u'JPEG', 'size': u'80x60',
+            'sharpen': False, 'densities': [2]}).digest, digest)
+        # A new option with a default value
+        default_options = ImageProcessor.DEFAULT_OPTIONS
+        ImageProcessor.DEFAULT_OPTIONS = dict(default_options, grayscale=False)
+        try:
+            self.assertEqual(ImageSpec('avatar', dict(size='80x60', format='JPEG')).digest, digest)
+        finally:
+            ImageProcessor.DEFAULT_OPTIONS = default_options
+        self.assertNotEqual(ImageSpec('avatar', dict(size='80x60', format='PNG')).digest, digest)
+        self.assertNotEqual(ImageSpec('avatar', dict(size='80x60', format='JPEG',
+            encoder_options={'quality': 70})).digest, digest)
+
+
+class EncoderOptionsTest(TestCase):
+    
+    def test_save_options(self):
+        calls = []
+        save = Image.Image.save
+        def save_image(im, fp, format=None, **params):
+            calls.append((format, params))
+            return save(im, fp, format, **params)
+        Image.Image.save = save_image
+        try:
+            processor = get_processor(size='80x60', format='WEBP',
+                encoder_options={'method': 6, 'lossless': True})
+            content = processor.encode_image(Image.new('RGB', (80, 60)))
+        finally:
+            Image.Image.save = save
+        self.assertEqual(calls, [('WEBP', {'method': 6, 'lossless': True})])
+        self.assertEqual(Image.open(content).format, 'WEBP')
+    
+    def test_format_settings(self):
+        old_options = settings.THUMBNAILS_ENCODER_OPTIONS
+        settings.THUMBNAILS_ENCODER_OPTIONS = {'WEBP': {'method': 4, 'quality': 90}}
+        try:
+            spec = ImageSpec('test', dict(format='WEBP', encoder_options={'method': 6}))
+        finally:
+            settings.THUMBNAILS_ENCODER_OPTIONS = old_options
+        self.assertEqual(spec.save_options, {'method': 6, 'quality': 90})
+    
+    def test_extensions(self):
+        for format, ext in (('WEBP', 'webp'), ('AVIF', 'avif'), ('JPEG', 'jpg'), ('TIFF', 'tiff')):
+            processor = get_processor(size='80x60', format=format)
+            self.assertEqual(processor.generate_image_name('images/photo.jpg'),
+                'images/%s/photo.test.%s' % (settings.THUMBNAILS_DIRNAME, ext))
+
+
+class MaxBytesTest(TestCase):
+    
+    def test_bytes_from_string(self):
+        self.assertEqual(get_bytes_from_string('30KB'), 30720)
+        self.assertEqual(get_bytes_from_string('1.5MB'), 1572864)
+        self.assertEqual(get_bytes_from_string(1000), 1000)
+    
+    def test_quality_search(self):
+        im = Image.effect_noise((256, 192), 64).convert('RGB')
+        processor = get_processor(max_bytes='12KB')
+        content = processor.encode_image(im)
+        self.assertTrue(content.size <= 12288)
+        self.assertTrue(content.size > get_processor().encode_image(im).size / 4)
+
+
+class ResampleTest(TestCase):
+    
+    def test_same_geometry(self):
+        im = Image.new('RGB', (1600, 1200))
+        for size in ('64x64', '100x300', '2000x100'):
+            for crop in (0, 1, 2):
+                for upscale in (False, True):
+                    expected = get_processor(size=size, crop=crop, upscale=upscale).resize_image(im).size
+                    for speed in ('balanced', 'fast'):
+                        processor = get_processor(size=size, crop=crop, upscale=upscale,
+                            resample='bicubic', speed=speed)
+                        self.assertEqual(processor.resize_image(im).size, expected)
+    
+    def test_reduction(self):
+        im = Image.new('RGB', (1600, 1200))
+        processor = get_processor(size='100x75', resample='bicubic', speed='balanced')
+        calls = []
+        resize = Image.Image.resize
+        reduce = getattr(Image.Image, 'reduce', None)
+        def record_resize(self, size, *args, **kwargs):
+            calls.append(('resize', tuple(size)))
+            return resize(self, size, *args, **kwargs)
+        def record_reduce(self, factor, *args, **kwargs):
+            calls.append(('reduce', factor))
+            return reduce(self, factor, *args, **kwargs)
+        Image.Image.resize = record_resize
+        try:
+            if reduce is not None:
+                Image.Image.reduce = record_reduce
+                processor.resize_image(im)
+                self.assertEqual(calls, [('reduce', 5), ('resize', (100, 75))])
+                # Without reduce(), the image is reduced with the box filter
+                del Image.Image.reduce
+                calls = []
+            processor.resize_image(im)
+            self.assertEqual(calls, [('resize', (320, 240)), ('resize', (100, 75))])
+        finally:
+            Image.Image.resize = resize
+            if reduce is not None:
+                Image.Image.reduce = reduce
+    
+    def test_invalid_options(self):
+        self.assertRaises(ThumbnailOptionError, ImageSpec, None, dict(resample='sinc'))
+        self.assertRaises(ThumbnailOptionError, ImageSpec, None, dict(speed='warp'))
+    
+    def test_derived_images(self):
+        # PNG images are decoded the same way for any thumbnail sizes
+        data = get_image_data((1600, 1200), 'PNG')
+        small = get_processor(size='100x75')
+        expected = process_images([small], ContentFile(data))[0].read()
+        for proc_opts in (dict(resample='nearest'), dict(speed='fast')):
+            large = get_processor(size='400x300', **proc_opts)
+            contents = process_images([large, small], ContentFile(data))
+            self.assertEqual(contents[1].read(), expected)
+        self.assertTrue(small.has_default_resampling())
+        self.assertFalse(large.has_default_resampling())
+
+
+class StageTimedTest(TestCase):
+    
+    def setUp(self):
+        self.events = []
+        stage_timed.connect(self.receiver)
+    
+    def tearDown(self):
+        stage_timed.disconnect(self.receiver)
+    
+    def receiver(self, sender, **kwargs):
+        self.events.append(kwargs)
+    
+    def test_process_image(self):
+        buffer = StringIO()
+        Image.new('RGB', (400, 300)).save(buffer, 'PNG')
+        get_processor(size='80x60', sharpen=True).process_image(File(buffer))
+        self.assertEqual([e['stage'] for e in self.events],
+            ['decode', 'orientation', 'resize', 'filter', 'encode'])
+        resize = self.events[2]
+        self.assertEqual(resize['identifier'], 'test')
+        self.assertEqual(resize['source_size'], (400, 300))
+        self.assertEqual(resize['output_size'], (80, 60))
+        self.assertTrue(resize['elapsed'] >= 0)
+
+    def test_passthrough(self):
+        buffer = StringIO()
+        Image.new('RGB', (400, 300)).save(buffer, 'PNG')
+        content = get_processor(size='800x600', format='PNG').process_image(File(buffer))
+        self.assertEqual([e['stage'] for e in self.events], ['passthrough'])
+        self.assertEqual(content.read(), buffer.getvalue())
+        get_processor(size='800x600', format='JPEG').process_image(File(buffer))
+        self.assertEqual(self.events[-1]['stage'], 'encode')
+
+class PassThroughTest(TestCase):
+    
+    def get_content(self, data, **proc_opts):
+        processor = get_processor(size='800x600', format='JPEG', **proc_opts)
+        return processor.process_image(File(StringIO(data))).read()
+    
+    def test_kept_metadata(self):
+        buffer = StringIO()
+        Image.new('RGB', (400, 300)).save(buffer, 'JPEG', icc_profile=b'icc' * 100)
+        data = buffer.getvalue()
+        self.assertEqual(self.get_content(data, strip_metadata=False), data)
+        self.assertNotEqual(self.get_content(data), data)
+    
+    def test_other_metadata(self):
+        buffer = StringIO()
+        Image.new('RGB', (400, 300)).save(buffer, 'JPEG')
+        data = buffer.getvalue()
+        self.assertEqual(self.get_content(data), data)
+        # XMP data in an APP1 segment and IPTC data in an APP13 segment
+        for marker, segment in ((b'\xff\xe1', b'http://ns.adobe.com/xap/1.0/\0<x:xmpmeta/>'),
+                (b'\xff\xed', b'Photoshop 3.0\x008BIM\x04\x04\0\0\0\0\0\0')):
+            size = len(segment) + 2
+            other = data[:2] + marker + bytes(bytearray([size >> 8, size & 255])) + segment + data[2:]
+            self.assertNotEqual(self.get_content(other, strip_metadata=False), other)
+
+
+class MetricsCollectorTest(TestCase):
+    
+    def test_render(self):
+        collector = MetricsCollector(buckets=(0.1, 1.0))
+        collector.increment('thumbnail_works_storage_exists_total')
+        collector.increment('thumbnail_works_storage_exists_total')
+        collector.observe('thumbnail_works_generation_seconds', 0.5, identifier='a"b')
+        self.assertEqual(collector.get_value('thumbnail_works_storage_exists_total'), 2)
+        lines = collector.render().splitlines()
+        self.assertTrue('thumbnail_works_storage_exists_total 2' in lines)
+        self.assertTrue('thumbnail_works_generation_seconds_bucket{identifier="a\\"b",le="0.1"} 0' in lines)
+        self.assertTrue('thumbnail_works_generation_seconds_bucket{identifier="a\\"b",le="+Inf"} 1' in lines)
+        self.assertTrue('thumbnail_works_generation_seconds_count{identifier="a\\"b"} 1' in lines)
+
+
+class MultiOutputTest(FieldTestCase):
+    
+    def test_same_dimensions(self):
+        self.set_setting('THUMBNAILS_DELAYED_GENERATION', False)
+        photo = self.create_photo('batch.jpg')
+        self.assertEqual(len(self.list_thumbnails()), 4)
+        self.set_setting('THUMBNAILS_DELAYED_GENERATION', True)
+        delayed = self.create_photo('delayed.jpg')
+        self.assertEqual(len(self.list_thumbnails()), 4)
+        for identifier in Photo._meta.get_field('image').thumbnail_specs:
+            t = getattr(photo.image, identifier)
+            expected = get_image_size(storage, getattr(delayed.image, identifier).name)
+            self.assertEqual(get_image_size(storage, t.name), expected)
+            self.assertEqual((t.width, t.height), expected)
+        self.assertEqual(len(self.list_thumbnails()), 8)
+    
+    def test_uneven_ratio(self):
+        sizes = ('500x333', '300x200', '120x80', '100x66', '80x60')
+        for source_size in ((4000, 3000), (3000, 2000)):
+            # BMP images are not decoded at a reduced size
+            buffer = StringIO()
+            Image.effect_noise(source_size, 64).save(buffer, 'BMP')
+            contents = process_images([get_processor(size=size) for size in sizes],
+                ContentFile(buffer.getvalue()))
+            for size, content in zip(sizes, contents):
+                expected = process_images([get_processor(size=size)],
+                    ContentFile(buffer.getvalue()))[0]
+                self.assertEqual(content.image_size, expected.image_size)
+                self.assertEqual(Image.open(content).size, expected.image_size)
+
+
+class ThreadPoolTest(FieldTestCase):
+    
+    def setUp(self):
+        super(ThreadPoolTest, self).setUp()
+        self.set_setting('THUMBNAILS_WORKERS', 2)
+    
+    def test_error_propagation(self):
+        def func(item):
+            if item == 3:
+                raise ValueError(item)
+            return item * 2
+        self.assertEqual(run_tasks(func, [1, 2]), [2, 4])
+        self.assertRaises(ValueError, run_tasks, func, [1, 2, 3, 4])
+    
+    def test_generation(self):
+        self.set_setting('THUMBNAILS_DELAYED_GENERATION', False)
+        photo = self.create_photo()
+        self.assertEqual(len(self.list_thumbnails()), 4)
+        photo.image.delete(save=False)
+        self.assertEqual(self.list_thumbnails(), [])
+
+
+class ProcessPoolBackendTest(TestCase):
+    
+    def test_same_results(self):
+        thumbnails = [dict(size='80x60'), dict(size='100x100', crop=True),
+            dict(size='400x100', format='PNG', sharpen=True)]
+        data = get_image_data()
+        expected = InProcessBackend().process_images(
+            [get_processor(**t) for t in thumbnails], ContentFile(data))
+        backend = ProcessPoolBackend()
+        try:
+            contents = backend.process_images(
+                [get_processor(**t) for t in thumbnails], ContentFile(data))
+        finally:
+            if backend._pool is not None:
+                backend._pool.terminate()
+        for content, other in zip(contents, expected):
+            self.assertEqual(content.image_size, other.image_size)
+            self.assertEqual(content.image_format, other.image_format)
+            self.assertEqual(Image.open(content).size, other.image_size)
+
+
+class ManifestTest(FieldTestCase):
+    
+    def test_entries(self):
+        spec = ImageSpec('avatar', dict(size='80x60'))
+        other = ImageSpec('avatar', dict(size='80x80'))
+        m = ThumbnailManifest(max_entries=2)
+        m.set('a.jpg', 'avatar', spec, {'name': 'a.avatar.jpg'})
+        self.assertEqual(m.get('a.jpg', 'avatar', spec), {'name': 'a.avatar.jpg'})
+        self.assertEqual(m.get('a.jpg', 'avatar', other), None)
+        m.set('b.jpg', 'avatar', spec, {'name': 'b.avatar.jpg'})
+        m.get('a.jpg', 'avatar', spec)
+        m.set('c.jpg', 'avatar', spec, {'name': 'c.avatar.jpg'})
+        # The least recently used entry is evicted
+        self.assertEqual(m.get('b.jpg', 'avatar', spec), None)
+        self.assertNotEqual(m.get('a.jpg', 'avatar', spec), None)
+        m.delete('a.jpg', 'avatar', spec)
+        self.assertEqual(m.get('a.jpg', 'avatar', spec), None)
+    
+    def test_shared_cache(self):
+        spec = ImageSpec('avatar', dict(size='80x60'))
+        m = ThumbnailManifest(cache_alias='default')
+        other = ThumbnailManifest(cache_alias='default')
+        m.set('a.jpg', 'avatar', spec, {'name': 'a.avatar.jpg'})
+        self.assertEqual(other.get('a.jpg', 'avatar', spec), {'name': 'a.avatar.jpg'})
+        m.delete('a.jpg', 'avatar', spec)
+        other.clear()
+        self.assertEqual(other.get('a.jpg', 'avatar', spec), None)
+    
+    def test_no_storage_access(self):
+        photo = self.create_photo()
+        avatar = photo.image.avatar
+        exists = storage.exists
+        storage.exists = None
+        try:
+            photo = Photo(image=photo.image.name)
+            self.assertEqual(photo.image.avatar.name, avatar.name)
+            self.assertEqual(photo.image.avatar.width, 80)
+        finally:
+            storage.exists = exists
+    
+    def test_replaced_image(self):
+        photo = self.create_photo()
+        spec = photo.image.avatar.spec
+        name = photo.image.name
+        # Another process deletes the image and saves a new one of the same
+        # name, while this process still has the entries of the thumbnails
+        entry = manifest.get(name, 'avatar', spec)
+        for path in [photo.image.avatar.name, name]:
+            storage.delete(path)
+        manifest.set(name, 'avatar', spec, entry)
+        photo = self.create_photo(data=get_image_data((400, 400)))
+        self.assertEqual(photo.image.name, name)
+        self.assertTrue(manifest.get(name, 'avatar', spec)['missing'])
+        self.assertEqual((photo.image.avatar.width, photo.image.avatar.height), (60, 60))
+
+
+class DatabaseQueueTest(FieldTestCase):
+    
+    def setUp(self):
+        super(DatabaseQueueTest, self).setUp()
+        self.set_setting('THUMBNAILS_GENERATION_QUEUE', 'thumbnail_works.queues.DatabaseQueue')
+        queues._queue = None
+    
+    def tearDown(self):
+        queues._queue = None
+        super(DatabaseQueueTest, self).tearDown()
+    
+    def test_round_trip(self):
+        photo = self.create_photo()
+        self.assertTrue(photo.image.avatar.pending)
+        self.assertTrue(Photo(image=photo.image.name).image.avatar.pending)
+        self.assertEqual(ThumbnailJob.objects.count(), 1)
+        self.assertEqual(self.list_thumbnails(), [])
+        self.assertEqual(DatabaseQueue().process(), (1, 0))
+        self.assertEqual(ThumbnailJob.objects.count(), 0)
+        self.assertEqual(self.list_thumbnails(), ['photo.avatar.jpg'])
+        self.assertFalse(getattr(Photo(image=photo.image.name).image.avatar, 'pending', False))
+    
+    def test_command(self):
+        photo = self.create_photo()
+        photo.image.avatar
+        photo.image.square
+        call_command('process_thumbnail_queue', limit=1, stdout=self.devnull)
+        self.assertEqual(ThumbnailJob.objects.count(), 1)
+        call_command('process_thumbnail_queue', stdout=self.devnull)
+        self.assertEqual(self.list_thumbnails(), ['photo.avatar.jpg', 'photo.square.jpg'])
+    
+    def test_unicode_identifier(self):
+        photo = self.create_photo()
+        ThumbnailJob.objects.create(app_label='thumbnail_works', model_name='Photo',
+            field_name='image', name=photo.image.name, identifier=u'square')
+        self.assertEqual(DatabaseQueue().process(), (1, 0))
+        self.assertEqual(self.list_thumbnails(), ['photo.square.jpg'])
+    
+    def test_failed_jobs(self):
+        job = ThumbnailJob.objects.create(app_label='thumbnail_works', model_name='Photo',
+            field_name='image', name='photos/photo.jpg', identifier='unknown')
+        queue = DatabaseQueue()
+        # The errors are logged
+        queues.logger.disabled = True
+        try:
+            for i in range(queue.MAX_ATTEMPTS):
+                self.assertEqual(queue.process(), (1, 1))
+                # Failed jobs wait before they are tried again
+                self.assertEqual(queue.process(), (0, 0))
+                job = ThumbnailJob.objects.get(pk=job.pk)
+                self.assertTrue(job.next_attempt > queues.now())
+                ThumbnailJob.objects.filter(pk=job.pk).update(next_attempt=queues.now())
+        finally:
+            queues.logger.disabled = False
+        self.assertEqual(queue.process(), (0, 0))
+        self.assertEqual(ThumbnailJob.objects.get(pk=job.pk).attempts, queue.MAX_ATTEMPTS)
+
+
+class GenerateThumbnailsCommandTest(FieldTestCase):
+    
+    def test_checkpoint(self):
+        for name in ('a.jpg', 'b.jpg'):
+            self.create_photo(name)
+        checkpoint = os.path.join(storage.location, 'checkpoint.json')
+        call_command('generate_thumbnails', identifiers=['avatar', 'square'],
+            chunk_size=1, checkpoint=checkpoint, stdout=self.devnull)
+        self.assertEqual(self.list_thumbnails(), ['a.avatar.jpg', 'a.square.jpg',
+            'b.avatar.jpg', 'b.square.jpg'])
+        self.assertFalse(os.path.exists(checkpoint))
+        # Run again after the thumbnails are gone
+        shutil.rmtree(os.path.join(storage.location, 'photos', settings.THUMBNAILS_DIRNAME))
+        manifest.clear()
+        call_command('generate_thumbnails', identifiers=['avatar'],
+            checkpoint=checkpoint, stdout=self.devnull)
+        self.assertEqual(self.list_thumbnails(), ['a.avatar.jpg', 'b.avatar.jpg'])
+    
+    def test_errors(self):
+        self.create_photo('a.jpg', data=b'not an image')
+        self.create_photo('b.jpg')
+        stderr = tempfile.TemporaryFile('w+')
+        try:
+            call_command('generate_thumbnails', identifiers=['avatar'],
+                stdout=self.devnull, stderr=stderr)
+            stderr.seek(0)
+            errors = stderr.read().splitlines()
+        finally:
+            stderr.close()
+        self.assertEqual(len(errors), 1)
+        self.assertTrue(errors[0].startswith('photos/a.jpg: '))
+        self.assertEqual(self.list_thumbnails(), ['b.avatar.jpg'])
+
+
+class LockTest(FieldTestCase):
+    
+    def setUp(self):
+        super(LockTest, self).setUp()
+        self.lock_dir = tempfile.mkdtemp()
+        self.set_setting('THUMBNAILS_LOCK_DIR', self.lock_dir)
+        self.set_setting('THUMBNAILS_LOCK_BACKEND', 'thumbnail_works.locks.FileLock')
+        locks._lock = None
+    
+    def tearDown(self):
+        locks._lock = None
+        shutil.rmtree(self.lock_dir)
+        super(LockTest, self).tearDown()
+    
+    def test_file_lock(self):
+        lock = FileLock()
+        token = lock.acquire('a', 1)
+        self.assertNotEqual(token, None)
+        self.assertEqual(lock.acquire('a', 0.1), None)
+        other = lock.acquire('b', 0.1)
+        self.assertNotEqual(other, None)
+        lock.release(other)
+        lock.release(token)
+        self.assertEqual(os.listdir(self.lock_dir), [])
+        lock.release(lock.acquire('a', 0.1))
+    
+    def test_concurrent_access(self):
+        name = self.create_photo().image.name
+        generated = collector.get_value('thumbnail_works_thumbnails_generated_total',
+            identifier='medium')
+        results = []
+        def access():
+            results.append(Photo(image=name).image.medium)
+        threads = [threading.Thread(target=access) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(collector.get_value('thumbnail_works_thumbnails_generated_total',
+            identifier='medium'), generated + 1)
+        self.assertEqual(set([t.name for t in results]), set(['photos/thumbs/photo.medium.jpg']))
+        self.assertEqual(self.list_thumbnails(), ['photo.medium.jpg'])
+        self.assertEqual(os.listdir(self.lock_dir), [])
+    
+    def test_density_variants(self):
+        self.set_setting('THUMBNAILS_LOCK_TIMEOUT', 0.1)
+        name = self.create_photo(model=RetinaPhoto).image.name
+        # The variants are generated together with the 1x thumbnail
+        lock = FileLock()
+        token = lock.acquire('photos/thumbs/photo.avatar.jpg', 1)
+        try:
+            self.assertEqual(RetinaPhoto(image=name).image.get_thumbnail('avatar@2x'), None)
+            self.assertEqual(self.list_thumbnails(), [])
+        finally:
+            lock.release(token)
+        generated = collector.get_value('thumbnail_works_thumbnails_generated_total',
+            identifier='avatar@2x')
+        self.set_setting('THUMBNAILS_LOCK_TIMEOUT', 10)
+        threads = [threading.Thread(target=lambda identifier=identifier:
+                getattr(RetinaPhoto(image=name).image, identifier))
+            for identifier in ['avatar', 'avatar@2x', 'avatar@1.5x'] * 2]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(collector.get_value('thumbnail_works_thumbnails_generated_total',
+            identifier='avatar@2x'), generated + 1)
+        self.assertEqual(self.list_thumbnails(),
+            ['photo.avatar.jpg', 'photo.avatar@1.5x.jpg', 'photo.avatar@2x.jpg'])
+        self.assertEqual(os.listdir(self.lock_dir), [])
+
+
+class RemoteStorage(FileSystemStorage):
+    """Returns files that are not on the local filesystem."""
+    
+    def _open(self, name, mode='rb'):
+        f = super(RemoteStorage, self)._open(name, mode)
+        try:
+            return File(StringIO(f.read()), name=name)
+        finally:
+            f.close()
+
+
+class ImageContentTest(FieldTestCase):
+    
+    def test_streaming_reads(self):
+        self.set_setting('THUMBNAILS_SPOOL_MAX_SIZE', 1000)
+        data = get_image_data()
+        storage.save('photos/photo.jpg', ContentFile(data))
+        processor = get_processor(size='80x60')
+        processor.name = 'photos/photo.jpg'
+        processor.storage = storage
+        content = processor.get_image_content()
+        try:
+            self.assertEqual(content.read(), data)
+        finally:
+            content.close()
+        processor.storage = RemoteStorage(location=storage.location)
+        content = processor.get_image_content()
+        try:
+            # The data is copied to a temporary file
+            self.assertNotEqual(content.file.fileno(), None)
+            self.assertEqual(content.read(), data)
+            self.assertEqual(processor.process_image(content).image_size, (80, 60))
+        finally:
+            content.close()
+        processor.name = 'photos/missing.jpg'
+        self.assertRaises(NoAccessToImage, processor.get_image_content)
+    
+    def test_short_lived_reads(self):
+        opened = []
+        def open_(name, mode='rb'):
+            f = FileSystemStorage.open(storage, name, mode)
+            opened.append(f)
+            return f
+        closed = []
+        def resized(sender, stage, **kwargs):
+            if stage == 'resize':
+                closed.append([f.closed for f in opened])
+        photo = self.create_photo()
+        retina = self.create_photo(model=RetinaPhoto)
+        storage.open = open_
+        stage_timed.connect(resized)
+        try:
+            # A single thumbnail, a thumbnail with its density variants and
+            # the missing thumbnails of an image
+            Photo.objects.get(pk=photo.pk).image.avatar
+            RetinaPhoto.objects.get(pk=retina.pk).image.avatar
+            Photo.objects.get(pk=photo.pk).image.generate_missing_thumbnails()
+        finally:
+            stage_timed.disconnect(resized)
+            del storage.open
+        self.assertEqual(len(opened), 3)
+        self.assertEqual(len(closed), 1 + 3 + 3)
+        for states in closed:
+            self.assertTrue(False not in states)
+
+
+class MemoryBudgetTest(FieldTestCase):
+    
+    def test_draft_decoding(self):
+        data = get_image_data((1600, 1200))
+        self.set_setting('THUMBNAILS_MEMORY_BUDGET', 1000000)
+        processor = get_processor(size='80x60')
+        im = processor.open_image(ContentFile(data))
+        self.assertEqual(im.size, (200, 150))
+        self.assertEqual(processor.memory_usage['decoded'], 200 * 150 * 4)
+        self.assertTrue(processor.memory_usage['estimated'] <= 1000000)
+        processor = get_processor(size='800x600')
+        self.assertRaises(ImageTooLargeError, processor.open_image, ContentFile(data))
+        self.set_setting('THUMBNAILS_MEMORY_BUDGET', None)
+        self.set_setting('THUMBNAILS_MAX_PIXELS', 1000)
+        png = get_image_data((100, 100), 'PNG')
+        self.assertRaises(ImageTooLargeError, get_processor(size='10x10').open_image, ContentFile(png))
+
+
+class GenerationMetricsTest(FieldTestCase):
+    
+    def get_latency(self, identifier):
+        line = 'thumbnail_works_generation_seconds_sum{identifier="%s"} ' % identifier
+        for l in collector.render().splitlines():
+            if l.startswith(line):
+                return float(l[len(line):])
+        return 0
+    
+    def test_latency_includes_processing(self):
+        def slow_decoding(sender, stage, **kwargs):
+            if stage == 'decode':
+                time.sleep(0.05)
+        stage_timed.connect(slow_decoding)
+        try:
+            for delayed in (False, True):
+                self.set_setting('THUMBNAILS_DELAYED_GENERATION', delayed)
+                latency = self.get_latency('avatar')
+                photo = self.create_photo()
+                photo.image.avatar
+                self.assertTrue(self.get_latency('avatar') - latency >= 0.05)
+        finally:
+            stage_timed.disconnect(slow_decoding)
+
+
+class ThumbnailURLTest(FieldTestCase):
+    
+    def test_delayed_generation(self):
+        photo = self.create_photo()
+        self.assertEqual(self.list_thumbnails(), [])
+        self.assertEqual(photo.image.thumbnail_url('avatar'), '/media/photos/thumbs/photo.avatar.jpg')
+        self.assertEqual(self.list_thumbnails(), ['photo.avatar.jpg'])
+        self.assertEqual(Photo(image=photo.image.name).image.thumbnail_urls['square'],
+            '/media/photos/thumbs/photo.square.jpg')
+        self.assertEqual(self.list_thumbnails(), ['photo.avatar.jpg', 'photo.square.jpg'])
+    
+    def test_no_storage_access(self):
+        self.set_setting('THUMBNAILS_DELAYED_GENERATION', False)
+        name = self.create_photo().image.name
+        exists, open_ = storage.exists, storage.open
+        storage.exists = storage.open = None
+        try:
+            image = Photo(image=name).image
+            self.assertEqual(image.thumbnail_url('wide'), '/media/photos/thumbs/photo.wide.png')
+            self.assertFalse('wide' in image.__dict__)
+        finally:
+            storage.exists, storage.open = exists, open_
+    
+    def test_other_processes(self):
+        name = self.create_photo().image.name
+        # A process that has not seen the image generates the thumbnail
+        manifest.clear()
+        self.assertEqual(Photo(image=name).image.thumbnail_url('avatar'),
+            '/media/photos/thumbs/photo.avatar.jpg')
+        self.assertEqual(self.list_thumbnails(), ['photo.avatar.jpg'])
+        # and finds the thumbnails that exist already
+        manifest.clear()
+        save = storage.save
+        storage.save = None
+        try:
+            self.assertEqual(Photo(image=name).image.thumbnail_url('avatar'),
+                '/media/photos/thumbs/photo.avatar.jpg')
+        finally:
+            storage.save = save
+        # The entries of a shared manifest are trusted
+        manifest.clear()
+        manifest.cache_alias = 'default'
+        exists = storage.exists
+        storage.exists = None
+        try:
+            self.assertEqual(Photo(image=name).image.thumbnail_url('square'),
+                '/media/photos/thumbs/photo.square.jpg')
+        finally:
+            manifest.cache_alias = None
+            storage.exists = exists
+
+
+class PrefetchThumbnailsTest(FieldTestCase):
+    
+    def test_single_listdir(self):
+        self.set_setting('THUMBNAILS_DELAYED_GENERATION', False)
+        photos = [self.create_photo() for i in range(3)]
+        manifest.clear()
+        calls = []
+        def listdir(path):
+            calls.append(path)
+            return FileSystemStorage.listdir(storage, path)
+        storage.listdir = listdir
+        storage.exists = storage.open = None
+        try:
+            photos = prefetch_thumbnails([Photo(image=p.image.name) for p in photos], 'image')
+            self.assertEqual(calls, ['photos/thumbs'])
+            for photo in photos:
+                for identifier in ('avatar', 'square', 'medium', 'wide'):
+                    self.assertTrue(identifier in photo.image.__dict__)
+                self.assertEqual(photo.image.avatar.url, '/media/photos/thumbs/%s' %
+                    os.path.basename(photo.image.avatar.name))
+        finally:
+            del storage.listdir, storage.exists, storage.open
+    
+    def test_missing_thumbnails(self):
+        photo = self.create_photo()
+        photos = prefetch_thumbnails([photo], 'image', identifiers=['avatar'])
+        self.assertFalse('avatar' in photos[0].image.__dict__)
+        exists = collector.get_value('thumbnail_works_storage_exists_total')
+        photos = prefetch_thumbnails([photo], 'image', identifiers=['avatar'], generate=True)
+        self.assertEqual(self.list_thumbnails(), ['photo.avatar.jpg'])
+        self.assertEqual(photos[0].image.__dict__['avatar'].width, 80)
+        # The thumbnails are not looked up on the storage again
+        self.assertEqual(collector.get_value('thumbnail_works_storage_exists_total'), exists)
+    
+    def test_unreadable_images(self):
+        photos = [self.create_photo('a.jpg'), self.create_photo('b.jpg')]
+        storage.delete(photos[0].image.name)
+        prefetch_thumbnails(photos, 'image', identifiers=['avatar'], generate=True)
+        self.assertEqual(self.list_thumbnails(), ['b.avatar.jpg'])
+    
+    def test_generation_queue(self):
+        self.set_setting('THUMBNAILS_GENERATION_QUEUE', 'thumbnail_works.queues.DatabaseQueue')
+        queues._queue = None
+        try:
+            photos = prefetch_thumbnails([self.create_photo()], 'image',
+                identifiers=['avatar'], generate=True)
+        finally:
+            queues._queue = None
+        self.assertTrue(photos[0].image.avatar.pending)
+        self.assertEqual(ThumbnailJob.objects.count(), 1)
+        self.assertEqual(self.list_thumbnails(), [])
+    
+    def test_locks(self):
+        lock_dir = tempfile.mkdtemp()
+        self.set_setting('THUMBNAILS_LOCK_DIR', lock_dir)
+        self.set_setting('THUMBNAILS_LOCK_BACKEND', 'thumbnail_works.locks.FileLock')
+        locks._lock = None
+        try:
+            photo = self.create_photo()
+            self.assertEqual(prefetch_thumbnails([photo], 'image', identifiers=['avatar'],
+                generate=True)[0].image.avatar.width, 80)
+            self.assertEqual(os.listdir(lock_dir), [])
+            # Found missing before another process generated the thumbnail
+            manifest.clear()
+            image = Photo(image=photo.image.name).image
+            self.assertEqual(image._generate_found_missing([photo.image.avatar]), 0)
+            self.assertEqual(image.__dict__['avatar'].width, 80)
+            self.assertEqual(os.listdir(lock_dir), [])
+        finally:
+            locks._lock = None
+            shutil.rmtree(lock_dir)
+
+
+class DeleteImagesTest(FieldTestCase):
+    
+    def setUp(self):
+        super(DeleteImagesTest, self).setUp()
+        self.set_setting('THUMBNAILS_DELAYED_GENERATION', False)
+        self.photos = [self.create_photo() for i in range(2)]
+    
+    def test_delete(self):
+        self.assertEqual(delete_images(self.photos, 'image'), 10)
+        self.assertEqual(storage.listdir('photos'), (['thumbs'], []))
+        self.assertEqual(self.list_thumbnails(), [])
+        self.assertTrue(manifest.get(self.photos[0].image.name, 'avatar',
+            Photo._meta.get_field('image').thumbnail_specs['avatar']) is None)
+    
+    def test_delete_many(self):
+        calls = []
+        def delete_many(names):
+            calls.append(names)
+            for name in names:
+                FileSystemStorage.delete(storage, name)
+        storage.delete_many = delete_many
+        storage.delete = None
+        try:
+            delete_images(self.photos, 'image')
+        finally:
+            del storage.delete_many, storage.delete
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(calls[0]), 10)
+        self.assertEqual(self.list_thumbnails(), [])
+
+
+class ContentAddressedTest(FieldTestCase):
+    
+    def setUp(self):
+        super(ContentAddressedTest, self).setUp()
+        self.set_setting('THUMBNAILS_DELAYED_GENERATION', False)
+    
+    def test_shared_images(self):
+        photos = [self.create_photo(name, model=SharedPhoto) for name in ('a.jpg', 'b.jpg')]
+        name = photos[0].image.name
+        self.assertEqual(photos[1].image.name, name)
+        thumbnails = self.list_thumbnails()
+        self.assertEqual(len(thumbnails), 2)
+        self.assertNotEqual(self.create_photo(data=get_image_data((640, 480)),
+            model=SharedPhoto).image.name, name)
+        photos[0].image.delete()
+        self.assertTrue(storage.exists(name))
+        self.assertTrue(set(thumbnails) <= set(self.list_thumbnails()))
+        photos[1].image.delete()
+        self.assertFalse(storage.exists(name))
+        self.assertFalse(set(thumbnails) & set(self.list_thumbnails()))
+    
+    def test_delete_images(self):
+        photos = [self.create_photo(model=SharedPhoto) for i in range(2)]
+        name = photos[0].image.name
+        self.assertEqual(delete_images(photos[:1], 'image'), 0)
+        self.assertTrue(storage.exists(name))
+        self.assertEqual(delete_images(photos, 'image'), 3)
+        self.assertFalse(storage.exists(name))
+
+
+class SrcsetTest(FieldTestCase):
+    
+    def test_srcset(self):
+        photo = self.create_photo(model=RetinaPhoto)
+        self.assertEqual(photo.image.srcsets['avatar'], ', '.join([
+            storage.url('photos/thumbs/photo.avatar.jpg') + ' 1x',
+            storage.url('photos/thumbs/photo.avatar@1.5x.jpg') + ' 1.5x',
+            storage.url('photos/thumbs/photo.avatar@2x.jpg') + ' 2x']))
+        # The variants are generated with the thumbnail
+        self.assertEqual(self.list_thumbnails(),
+            ['photo.avatar.jpg', 'photo.avatar@1.5x.jpg', 'photo.avatar@2x.jpg'])
+        for name, size in (('photo.avatar.jpg', (80, 60)),
+                ('photo.avatar@1.5x.jpg', (120, 90)), ('photo.avatar@2x.jpg', (160, 120))):
+            self.assertEqual(get_image_size(storage, 'photos/thumbs/' + name), size)
+    
+    def test_without_densities(self):
+        photo = self.create_photo()
+        self.assertEqual(photo.image.srcsets['avatar'], '/media/photos/thumbs/photo.avatar.jpg 1x')
+        self.assertRaises(KeyError, lambda: photo.image.srcsets['unknown'])
+
+
 __test__ = {"doctest": """
 Another way to test that 1 + 1 is equal to 2.
 
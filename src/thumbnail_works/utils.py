@@ -24,8 +24,32 @@
 #  limitations under the License.
 #
 
-from thumbnail_works.exceptions import ImageSizeError
+try:
+    from importlib import import_module
+except ImportError:
+    from django.utils.importlib import import_module
 
+from thumbnail_works.exceptions import ImageSizeError, ThumbnailOptionError
+from thumbnail_works.exceptions import ThumbnailWorksError
+
+
+
+class ReadOnlyDict(dict):
+    """A dictionary that cannot be modified, for values that are shared
+    between objects. Copies made with ``dict()`` or ``copy()`` can be
+    modified."""
+    
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('%s objects cannot be modified' % self.__class__.__name__)
+    
+    __setitem__ = __delitem__ = __ior__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+    
+    def copy(self):
+        return dict(self)
+    
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
 
 
 def get_width_height_from_string(size):
@@ -49,3 +73,82 @@ def get_width_height_from_string(size):
         raise ImageSizeError('size\'s WIDTH and HEIGHT must be integers')
     return size_x, size_y
 
+
+def get_bytes_from_string(size):
+    """Returns a number of bytes.
+    
+    Accepts an integer or a string such as ``30000``, ``30KB`` or ``1.5MB``.
+    A kilobyte is 1024 bytes.
+    
+    Raises ThumbnailOptionError on an invalid number of bytes.
+    
+    """
+    if isinstance(size, int):
+        return size
+    try:
+        value = size.strip().upper()
+    except AttributeError:
+        raise ThumbnailOptionError('max_bytes must be an integer or a string such as 30KB')
+    multiplier = 1
+    for unit, unit_multiplier in (('KB', 1024), ('MB', 1024 * 1024), ('B', 1)):
+        if value.endswith(unit):
+            value = value[:-len(unit)].strip()
+            multiplier = unit_multiplier
+            break
+    try:
+        return int(float(value) * multiplier)
+    except ValueError:
+        raise ThumbnailOptionError('max_bytes must be an integer or a string such as 30KB')
+
+
+def import_object(path):
+    """Returns the object at the dotted ``path``.
+    
+    Raises ThumbnailWorksError if the object cannot be imported.
+    
+    """
+    try:
+        module_name, object_name = path.rsplit('.', 1)
+        return getattr(import_module(module_name), object_name)
+    except (ValueError, ImportError, AttributeError):
+        raise ThumbnailWorksError('Cannot import `%s`' % path)
+
+
+def get_model(app_label, model_name):
+    """Returns the model class ``app_label.model_name``."""
+    try:
+        from django.apps import apps
+    except ImportError:
+        from django.db.models import get_model
+        return get_model(app_label, model_name)
+    return apps.get_model(app_label, model_name)
+
+
+def get_models():
+    """Returns all the installed model classes."""
+    try:
+        from django.apps import apps
+    except ImportError:
+        from django.db.models import get_models
+        return get_models()
+    return apps.get_models()
+
+
+def get_option_list(option_list, arguments):
+    """Returns the ``option_list`` of a management command for Django
+    versions before 1.10, which parse the options with optparse.
+    
+    ``arguments`` is a sequence of the ``(args, kwargs)`` that are passed to
+    ``parser.add_argument()`` in the ``add_arguments()`` method of the command
+    on later versions.
+    
+    """
+    from optparse import make_option
+    types = {int: 'int', float: 'float'}
+    options = []
+    for args, kwargs in arguments:
+        kwargs = dict(kwargs)
+        if 'type' in kwargs:
+            kwargs['type'] = types[kwargs['type']]
+        options.append(make_option(*args, **kwargs))
+    return option_list + tuple(options)
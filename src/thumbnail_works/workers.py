@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+#
+#  This file is part of django-thumbnail-works.
+#
+#  django-thumbnail-works adds thumbnail support to the default ImageField.
+#
+#  Development Web Site:
+#    - http://www.codetrax.org/projects/django-thumbnail-works
+#  Public Source Code Repository:
+#    - https://source.codetrax.org/hgroot/django-thumbnail-works
+#
+#  Copyright 2010 George Notaras <gnot [at] g-loaded.eu>
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+
+"""Shared pools used to generate and delete thumbnails concurrently."""
+
+import atexit
+import threading
+from multiprocessing.pool import ThreadPool
+
+from thumbnail_works import settings
+
+
+_thread_pool = None
+_thread_pool_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_thread_pool():
+    """Returns the shared thread pool.
+    
+    The pool is created on first use with ``THUMBNAILS_WORKERS`` threads.
+    ``None`` is returned if ``THUMBNAILS_WORKERS`` is less than 2.
+    
+    """
+    global _thread_pool
+    if settings.THUMBNAILS_WORKERS < 2:
+        return None
+    if _thread_pool is None:
+        with _thread_pool_lock:
+            if _thread_pool is None:
+                _thread_pool = ThreadPool(settings.THUMBNAILS_WORKERS)
+                atexit.register(_thread_pool.terminate)
+    return _thread_pool
+
+
+def _run_task(args):
+    func, item = args
+    _local.in_pool = True
+    try:
+        return func(item)
+    finally:
+        _local.in_pool = False
+
+
+def run_tasks(func, items):
+    """Calls ``func`` for every item of ``items`` and returns the results
+    in the same order.
+    
+    The calls are distributed to the shared thread pool, if one has been
+    configured. The first exception raised by any of the calls is raised
+    again in the calling thread.
+    
+    Tasks that are already running in the pool are not distributed again,
+    so as to avoid exhausting the pool.
+    
+    """
+    items = list(items)
+    pool = get_thread_pool()
+    if pool is None or len(items) < 2 or getattr(_local, 'in_pool', False):
+        return [func(item) for item in items]
+    return pool.map(_run_task, [(func, item) for item in items])